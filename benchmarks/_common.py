@@ -0,0 +1,29 @@
+"""Shared timing and command line setup of the benchmark scripts"""
+import argparse
+import time
+
+def timeit(func, *args, **kwargs):
+    """Wall clock seconds of one call of func"""
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def parser(doc, rows):
+    """Argument parser with the --rows option every benchmark takes
+
+    Parameters
+    ----------
+    doc : str
+             Description, the benchmark module's docstring
+    rows : int
+             Default number of synthetic rows
+    """
+    p = argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--rows', type=int, default=rows)
+    return p
+
+def report(results):
+    """Prints one aligned line of seconds per timed result"""
+    width = max(len(k) for k in results) + 4
+    for k,v in results.items():
+        print('{:<{}}{:>10.2f}s'.format(k, width, v))
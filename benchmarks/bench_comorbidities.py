@@ -0,0 +1,55 @@
+"""Benchmark of the compiled PrefixMatcher against matching each prefix with str.startswith
+
+Usage::
+
+    python benchmarks/bench_comorbidities.py --rows 5000000
+"""
+import numpy as np
+import pandas as pd
+from tricorder.comorbidities import PrefixMatcher, flag_comorbidities
+from _common import timeit, parser, report
+
+def _normalize(codes):
+    return pd.Index(codes, dtype=object).astype(str).str.replace('.', '', regex=False).str.upper()
+
+def match_startswith(codes, concepts):
+    # Implementation prior to the compiled matcher, one scan of the codes per concept
+    codes = _normalize(codes)
+    return np.column_stack([codes.str.startswith(tuple(_normalize(p))) for p in concepts.values()])
+
+def synthetic_codes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    letters = rng.choice(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), n)
+    return pd.Series(letters).str.cat([
+        pd.Series(rng.integers(0, 100, n)).astype(str).str.zfill(2),
+        pd.Series(rng.integers(0, 1000, n)).astype(str),
+    ], sep='.')
+
+def synthetic_concepts(n_concepts=30, n_prefixes=40, seed=0):
+    # Roughly the size of the full Elixhauser code sets
+    codes = synthetic_codes(n_concepts*n_prefixes, seed=seed+1)
+    cut = np.random.default_rng(seed).integers(3, 6, len(codes))
+    prefixes = [c[:k] for c,k in zip(codes, cut)]
+    return {'concept_{}'.format(i) : prefixes[i*n_prefixes:(i+1)*n_prefixes] for i in range(n_concepts)}
+
+if __name__ == '__main__':
+    args = parser(__doc__, rows=5000000).parse_args()
+
+    codes = synthetic_codes(args.rows)
+    unique = codes.unique()
+    concepts = synthetic_concepts()
+    matcher = PrefixMatcher(concepts)
+    dx = pd.DataFrame({
+        'person_id' : np.arange(args.rows) // 20,
+        'Code' : codes.astype('category'),
+        'CodeDescription' : pd.Categorical(['']*args.rows),
+        'CodeType' : pd.Categorical(['ICD-10-CM']*args.rows),
+    })
+    print('synthetic diagnoses: {} rows, {} distinct codes, {} concepts'.format(len(codes), len(unique), len(concepts)))
+
+    results = {
+        'startswith, unique codes' : timeit(match_startswith, unique, concepts),
+        'compiled, unique codes' : timeit(matcher.match, unique),
+        'flag_comorbidities, CONCEPTS' : timeit(flag_comorbidities, dx),
+    }
+    report(results)
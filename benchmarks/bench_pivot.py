@@ -0,0 +1,42 @@
+"""Benchmark of the sort based pivot_tidy / melt_tidy against pandas pivot_table / melt
+
+Usage::
+
+    python benchmarks/bench_pivot.py --rows 1000000
+"""
+import numpy as np
+import pandas as pd
+from tricorder.utils import pivot_tidy, melt_tidy
+from _common import timeit, parser, report
+
+def pivot_tidy_pandas(df,t='time'):
+    # Implementation prior to the sort based engine
+    return df.pivot_table(index=['encounter_id',t],values='value', aggfunc='mean', columns='name', observed=True)
+
+def melt_tidy_pandas(df,t='hour'):
+    return pd.melt(df.reset_index(),id_vars=['encounter_id',t],value_vars=df.reset_index().columns.tolist(),var_name='name')
+
+def synthetic_metric(n, n_encounters=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'encounter_id' : rng.integers(0, n_encounters, n).astype(np.uint64),
+        'time' : pd.to_timedelta(rng.integers(0, 7*24, n), unit='h'),
+        'name' : pd.Categorical(rng.choice(['A-LINE MAP','CVP','CCO','CCI','PULSE'], n)),
+        'value' : rng.normal(80, 10, n),
+    })
+    return df.sort_values(['encounter_id','time']).reset_index(drop=True)
+
+def round_trip(pivot, melt, df):
+    return pivot(melt(pivot(df, t='time'), t='time'), t='time')
+
+if __name__ == '__main__':
+    args = parser(__doc__, rows=1000000).parse_args()
+
+    df = synthetic_metric(args.rows)
+    print('synthetic metric frame: {} rows'.format(len(df)))
+
+    results = {
+        'pandas pivot/melt/pivot' : timeit(round_trip, pivot_tidy_pandas, melt_tidy_pandas, df),
+        'sorted pivot/melt/pivot' : timeit(round_trip, pivot_tidy, melt_tidy, df),
+    }
+    report(results)
@@ -0,0 +1,52 @@
+"""Benchmark of the vectorized tidy_flow against the previous row-wise implementation
+
+Usage::
+
+    python benchmarks/bench_tidy.py --rows 10000000
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from tricorder.utils import tidy_flow
+from _common import timeit, parser, report
+
+def tidy_flow_apply(df,to_numeric=True):
+    # Implementation prior to vectorizing, timedeltas built one row at a time
+    df = df.rename(columns={'display_name':'name','flowsheet_value':'value','flowsheet_time':'time'})
+
+    if to_numeric:
+        df.value = pd.to_numeric(df.value,errors='coerce')
+
+    days = df.flowsheet_days_since_birth.apply(lambda s: pd.to_timedelta(s,unit='day'))
+
+    df.time = pd.to_timedelta(df.time) + days
+    df = df.dropna()
+    return df[['encounter_id','time','name','value']].sort_values(['encounter_id','time'],ascending=True)
+
+def synthetic_flowsheet(n, n_encounters=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 24*60*60, n)
+    return pd.DataFrame({
+        'encounter_id' : rng.integers(0, n_encounters, n).astype(np.uint64),
+        'flowsheet_days_since_birth' : rng.integers(18000, 32000, n).astype(np.uint64),
+        'flowsheet_time' : pd.to_timedelta(seconds, unit='s').astype(str).str[-8:],
+        'display_name' : rng.choice(['PULSE','CCO','CCI','CVP (MMHG)','A-LINE MAP '], n),
+        'flowsheet_value' : rng.normal(80, 10, n).round(1).astype(str),
+    })
+
+if __name__ == '__main__':
+    cli = parser(__doc__, rows=10000000)
+    cli.add_argument('--skip-old', action='store_true', help='only time the vectorized implementations')
+    args = cli.parse_args()
+
+    df = synthetic_flowsheet(args.rows)
+    tab = pa.Table.from_pandas(df, preserve_index=False)
+    print('synthetic flowsheet: {} rows'.format(len(df)))
+
+    results = {}
+    if not args.skip_old:
+        results['apply (old)'] = timeit(tidy_flow_apply, df.copy())
+    results['vectorized'] = timeit(tidy_flow, df)
+    results['vectorized, arrow in/out'] = timeit(tidy_flow, tab, as_arrow=True)
+
+    report(results)
@@ -44,4 +44,117 @@ def test_cohort():
         assert f in funcs_and_attrs
 
     assert isinstance(pc.mortality, pd.DataFrame)
-    assert isinstance(pc.age, pd.DataFrame)
\ No newline at end of file
+    assert isinstance(pc.age, pd.DataFrame)
+def test_cache():
+    pc.clear_cache()
+    first = pc.age
+    second = pc.age
+    assert pc.cache_info().hits == 1
+    assert first.equals(second)
+
+    pc.set_offset(pc.offset)
+    assert pc.cache_info().currsize == 0
+
+def test_postop_aki():
+    from tricorder.outcome_utils import aki_code_map
+    aki = pc.postop_aki()
+    assert isinstance(aki, pd.DataFrame)
+    assert aki.encounter_id.is_unique
+    assert aki.value.isin(list(aki_code_map.keys())).all()
+
+def test_fetch_plan():
+    assert pc.plan.covers('labs', pc.eid, lab_component_name=['CREATININE SERUM'])
+    assert not pc.plan.covers('labs', pc.eid, lab_component_name=['NOT A LAB'])
+    assert pc.plan.covers('flowsheet', pc.eid, display_name=['HEIGHT','WEIGHT'])
+
+    labs = pc.plan.sel('labs', lab_component_name=['CREATININE SERUM'], encounter_id=pc.eid)
+    assert set(labs.lab_component_name.unique()) <= {'CREATININE SERUM'}
+    assert set(labs.lab_component_name.cat.categories) <= {'CREATININE SERUM'}
+    assert 'labs' in pc.plan.tables
+
+def test_comorbidities():
+    from tricorder.comorbidities import flag_comorbidities
+    c = pc.comorbidities(['cad','chf','osa'])
+    assert list(c.columns) == ['encounter_id','cad','chf','osa']
+    assert (c[['cad','chf','osa']].dtypes == bool).all()
+    assert c.encounter_id.is_unique
+    assert c.cad.astype(int).tolist() == pc.cad.set_index('encounter_id').loc[c.encounter_id,'CAD'].tolist()
+
+    dx = pd.DataFrame({
+        'person_id' : [1,1,2],
+        'Code' : ['K70.30','I10','K7030'],
+        'CodeDescription' : ['ALCOHOLIC CIRRHOSIS','ESSENTIAL HYPERTENSION','ALCOHOLIC CIRRHOSIS'],
+        'CodeType' : ['ICD-10-CM']*3,
+    })
+    flags = flag_comorbidities(dx, ['liver_disease','renal_failure'])
+    assert flags.liver_disease.tolist() == [True,True]
+    assert not flags.renal_failure.any()
+
+def test_prefix_matcher():
+    from tricorder.comorbidities import PrefixMatcher
+    m = PrefixMatcher({'liver':['K70','K76.02'],'alcoholic':['K70.3'],'empty':[]})
+    hits = m.match(['K70.30','K7030','K70','K76.0','K76.021','I10',None])
+    assert hits.tolist() == [
+        [True,True,False],
+        [True,True,False],
+        [True,False,False],
+        [False,False,False],
+        [True,False,False],
+        [False,False,False],
+        [False,False,False],
+    ]
+
+def test_comorbidity_index():
+    from tricorder import elixhauser, charlson
+    elix = pc.comorbidity_index()
+    assert list(elix.columns) == ['encounter_id', *elixhauser.categories, 'score']
+    assert elix.encounter_id.is_unique
+
+    cci = pc.comorbidity_index('charlson')
+    assert list(cci.columns) == ['encounter_id', *charlson.categories, 'score']
+
+def test_score_comorbidities(tmp_path):
+    from tricorder.tables import Table, TableCache
+    from tricorder.comorbidities import score_comorbidities
+    pd.DataFrame([
+        (1,'I50.9','HEART FAILURE','ICD-10-CM'),
+        (1,'N18.3','CHRONIC KIDNEY DISEASE','ICD-10-CM'),
+        # ICD-9 E codes share their prefixes with ICD-10 E codes
+        (2,'E878.8','SURGICAL COMPLICATION','ICD-9-CM'),
+        (2,'E03.9','HYPOTHYROIDISM','ICD-10-CM'),
+        (3,'E11.9','TYPE 2 DIABETES','ICD-10-CM'),
+        (3,'E11.21','TYPE 2 DIABETES WITH NEPHROPATHY','ICD-10-CM'),
+        (3,'C50.9','BREAST CANCER','ICD-10-CM'),
+        (3,'C78.0','SECONDARY LUNG CANCER','ICD-10-CM'),
+    ], columns=['person_id','Code','CodeDescription','CodeType']).assign(Provenance='X').to_csv(tmp_path/'Table7_DX.csv', index=False)
+    dx = Table(str(tmp_path/'Table7_DX.csv'), table_cache=TableCache())
+
+    elix = score_comorbidities(dx)
+    assert elix.loc[1,'congestive_heart_failure'] and elix.loc[1,'renal_failure']
+    assert elix.loc[2,'hypothyroidism'] and not elix.loc[2,'fluid_electrolyte_disorders']
+    assert elix.loc[3,['diabetes_uncomplicated','diabetes_complicated','solid_tumor','metastatic_cancer']].all()
+    # Metastatic cancer supersedes the solid tumor
+    assert elix.score.to_dict() == {1:12, 2:0, 3:12}
+    assert score_comorbidities(dx).equals(elix)
+
+    # Complicated diabetes and metastatic tumor supersede their milder forms
+    assert score_comorbidities(dx, 'charlson').score.to_dict() == {1:3, 2:0, 3:8}
+
+def test_demographics():
+    assert pc.demographics.encounter_id.is_unique
+    assert set(pc.demographics.encounter_id) == set(pc.eid)
+    assert set(pc.gender.gender.dropna()) <= {'Male','Female'}
+    male = pc.male_gender.set_index('encounter_id')['male gender']
+    gender = pc.gender.set_index('encounter_id').gender
+    assert (male.dropna() == 'Male').all()
+    assert male.isna().sum() == (gender != 'Male').sum()
+
+def test_bmi():
+    bmi = pc.bmi
+    assert list(bmi.columns) == ['encounter_id','BMI']
+    assert bmi.encounter_id.is_unique
+    assert set(bmi.encounter_id) == set(pc.eid)
+
+    metric = pc.get_bmi(height_unit='m', weight_unit='kg').BMI
+    assert ((pc.get_bmi(height_unit='cm', weight_unit='kg').BMI * 1e-4 - metric).abs() < 1e-9).all()
+    assert pc.get_bmi(nearest=True).encounter_id.is_unique
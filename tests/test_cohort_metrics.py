@@ -0,0 +1,51 @@
+import pytest
+import numpy as np
+import pandas as pd
+from scipy.interpolate import interp1d
+from tricorder.cohort_metrics import compute_o2_content, o2_content_frame, segmented_interp
+
+def frame(rows):
+    return pd.DataFrame({
+        'encounter_id' : [r[0] for r in rows],
+        'time' : pd.to_timedelta([r[1] for r in rows], unit='D'),
+        'value' : [float(r[2]) for r in rows],
+    }, columns=['encounter_id','time','value'])
+
+def test_segmented_interp():
+    sid = [1,1,1,2]
+    sx = [2.,0.,4.,1.]
+    sy = [12.,10.,8.,5.]
+    qid = [1,1,1,1,2,2,3]
+    qx = [-1.,1.,3.,9.,0.,7.,1.]
+    out = segmented_interp(qid, qx, sid, sx, sy, missing=-1)
+    # Inside a series its own points are interpolated, outside it gets the series min/max,
+    # a single point series is constant and a series without points gets missing
+    np.testing.assert_allclose(out, [8.,11.,10.,12.,5.,5.,-1.])
+
+    for e in [1,2]:
+        x, y = np.array(sx)[np.array(sid) == e], np.array(sy)[np.array(sid) == e]
+        q = np.array(qx)[np.array(qid) == e]
+        if len(x) > 1:
+            expected = interp1d(x=x, y=y, bounds_error=False, fill_value=(y.min(),y.max()))(q)
+            np.testing.assert_allclose(out[np.array(qid) == e], expected)
+
+def test_o2_content_frame():
+    # Encounter 1 has saturations before, between and after its hemoglobins and a single PO2,
+    # encounter 2 has no hemoglobin or PO2 at all, encounter 3 a single hemoglobin
+    hgb = frame([(1,0.5,10),(1,1.5,14),(3,1.0,9)])
+    po2 = frame([(1,1.0,100)])
+    sat = frame([(1,0.25,90),(1,1.0,95),(1,2.0,98),(2,0.5,97),(2,1.5,99),(3,0.5,92),(3,2.0,94)])
+
+    out = o2_content_frame(hgb, sat, po2)
+    assert out.encounter_id.tolist() == sat.encounter_id.tolist()
+    np.testing.assert_allclose(out.day, sat.time / np.timedelta64(1,'D'))
+
+    e1 = out[out.encounter_id == 1].value.values
+    np.testing.assert_allclose(e1, [1.34*0.90*10+0.3, 1.34*0.95*12+0.3, 1.34*0.98*14+0.3])
+    assert out[out.encounter_id == 2].value.isna().all()
+
+    for e in [1,2,3]:
+        expected = compute_o2_content(hgb[hgb.encounter_id == e], sat[sat.encounter_id == e], po2[po2.encounter_id == e])
+        got = out[out.encounter_id == e]
+        np.testing.assert_allclose(got.day.values, expected.day.values)
+        np.testing.assert_allclose(got.value.values, expected.value.values)
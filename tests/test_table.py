@@ -1,12 +1,14 @@
 import pytest
 import os
+import json
 import numpy as np
 import pandas as pd
 import pyarrow.csv as csv
 import pyarrow.parquet as pq
 import pyarrow as pa
 from tricorder.procedure_codesets import cabg_names
-from tricorder.tables import Table, RAW_DTYPES, SEARCH_COLS
+from tricorder.tables import Table, TableCache, RAW_DTYPES, SEARCH_COLS, CENSORED_COLS
+from tricorder.utils import tidy_flow
 
 def get_table(tab_name):
     datadir = os.getenv('DEV_DATA_DIR') 
@@ -20,6 +22,30 @@ def test_init():
         assert os.path.exists(t.file_path)
         assert isinstance(t.columns(),list)
 
+def test_schema():
+    for tn in RAW_DTYPES.keys():
+        t = get_table(tn)
+        assert t.scan(cache=False).schema.equals(t.schema)
+        df = t.sel(cache=False)
+        assert list(df.columns) == list(t.head().columns) == t.schema.names
+        # Censored flags follow their column and aren't raw csv columns
+        for c in CENSORED_COLS[tn]:
+            assert list(df.columns).index('{}_censored'.format(c)) == list(df.columns).index(c) + 1
+        assert not any(c.endswith('_censored') for c in t.columns())
+
+    df = get_table('Table2_Flowsheet.csv').sel(display_name=['HEIGHT'], cache=False)
+    assert list(df.columns) == ['encounter_id','flowsheet_days_since_birth','flowsheet_days_since_birth_censored','flowsheet_time','display_name','flowsheet_value']
+    assert df.encounter_id.dtype == np.uint64
+    assert df.flowsheet_days_since_birth.dtype == np.int32
+    assert isinstance(df.flowsheet_time.iloc[0], str)
+
+def test_malformed_values(tmp_path):
+    fp = tmp_path/'Table2_Flowsheet.csv'
+    fp.write_text('encounter_id,flowsheet_days_since_birth,flowsheet_time,display_name,flowsheet_value\n1000,25737,10:03:26,PULSE,66\n10x0,25738,10:04:26,PULSE,67\n')
+    tab = Table(str(fp), table_cache=TableCache()).scan(cache=False)
+    # The malformed id is read as missing instead of failing the whole read
+    assert tab['encounter_id'].to_pylist() == [1000, None]
+
 def test_search():
     for tn in RAW_DTYPES.keys():
         t = get_table(tn)
@@ -29,7 +55,10 @@ def test_search():
 def test_unqiue():
     for tn in RAW_DTYPES.keys():
         t = get_table(tn)
-        assert type(t.unique('encounter_id')[0]) is str
+        if 'encounter_id' not in t.columns():
+            continue
+        assert pd.api.types.is_integer(t.unique('encounter_id',count=False)[0])
+        assert t.unique('encounter_id').name == 'encounter_id'
 
 def test_filter_table():
     for tn in RAW_DTYPES.keys():
@@ -44,4 +73,146 @@ def test_filter_table():
         result = t._filter_table(tab,**query)
         print(result)
 
-        assert isinstance(result,pa.Table)
\ No newline at end of file
+        assert isinstance(result,pa.Table)
+
+def test_scan():
+    t = get_table('Table2_Flowsheet.csv')
+    eids = t.scan(display_name=['HEIGHT'])['encounter_id'].to_pylist()[:5]
+    tab = t.scan(display_name=['HEIGHT','WEIGHT'],encounter_id=eids)
+
+    assert isinstance(tab,pa.Table)
+    assert set(tab['encounter_id'].to_pylist()) <= set(eids)
+    assert set(tab['display_name'].to_pylist()) <= {'HEIGHT','WEIGHT'}
+
+def test_table_cache():
+    datadir = os.getenv('DEV_DATA_DIR') 
+    t = Table(os.path.join(datadir,'compass','SWAN','raw','Table6_Procedures.csv'),table_cache=TableCache())
+    first = t.sel(order_name=cabg_names)
+    second = t.sel(order_name=cabg_names)
+
+    assert t.table_cache.misses == 1
+    assert t.table_cache.hits == 1
+    assert first.equals(second)
+
+def test_table_cache_too_large():
+    datadir = os.getenv('DEV_DATA_DIR') 
+    fp = os.path.join(datadir,'compass','SWAN','raw','Table1_Encounter_Info.csv')
+    # The file fits the budget but its decoded table doesn't
+    t = Table(fp,table_cache=TableCache(max_bytes=os.path.getsize(fp)))
+    first = t.sel(encounter_id=[1000,1001])
+
+    # Rejected once, later scans use pushdown without decoding the whole file again
+    assert t.table_cache.nbytes == 0
+    assert not t.table_cache.admits(0, t.file_path)
+    assert first.equals(t.sel(encounter_id=[1000,1001]))
+
+def test_pushdown_search_col():
+    t = get_table('Table2_Flowsheet.csv')
+    t = Table(t.file_path, table_cache=TableCache(max_bytes=0))
+    # The raw csv isn't uppercased yet, the search column is still pushed down case insensitively
+    assert t._pushdown_expression(t._dataset(cache=False), display_name=['HEIGHT']) is not None
+    pushed = t.sel(display_name=['HEIGHT'], cache=False)
+    assert len(pushed) > 0
+    assert pushed.equals(get_table('Table2_Flowsheet.csv').sel(display_name=['HEIGHT'], cache=False))
+
+def test_iter_sel():
+    t = get_table('Table2_Flowsheet.csv')
+    batches = list(t.iter_sel(display_name=['HEIGHT'],batch_size=10000))
+
+    assert all(isinstance(b,pa.Table) for b in batches)
+    assert sum(b.num_rows for b in batches) == len(t.sel(display_name=['HEIGHT'],streaming=True))
+
+def test_sel_columns():
+    t = get_table('Table2_Flowsheet.csv')
+    df = t.sel(display_name=['HEIGHT'],columns=['encounter_id','flowsheet_value'],cache=False)
+
+    assert list(df.columns) == ['encounter_id','flowsheet_value']
+    assert len(df) == len(t.sel(display_name=['HEIGHT'],cache=False))
+
+def test_sel_columns_censored(tmp_path):
+    fp = tmp_path/'Table2_Flowsheet.csv'
+    fp.write_text('encounter_id,flowsheet_days_since_birth,flowsheet_time,display_name,flowsheet_value\n'
+        '1000,25737,10:03:26,PULSE,66\n1000,>32871,10:04:26,PULSE,67\n1000,,10:05:26,PULSE,68\n1001,25738,10:03:26,PULSE,70\n')
+    # A zero byte cache budget forces the pushdown path
+    t = Table(str(fp), table_cache=TableCache(max_bytes=0))
+    query = {'display_name':['PULSE'], 'encounter_id':[1000]}
+    cols = ['encounter_id','flowsheet_value']
+
+    # Censored and missing day offsets are dropped whether or not they're among the columns returned
+    assert t.sel(**query).flowsheet_value.tolist() == ['66']
+    assert t.sel(columns=cols, **query).flowsheet_value.tolist() == ['66']
+    assert t.sel(columns=cols, streaming=True, **query).flowsheet_value.tolist() == ['66']
+    t.build_parquet_cache()
+    assert t.sel(columns=cols, **query).flowsheet_value.tolist() == ['66']
+    assert t.sel(columns=cols, streaming=True, **query).flowsheet_value.tolist() == ['66']
+
+def test_parse_censored():
+    t = get_table('Table3_Lab.csv')
+    tab = t.scan(cache=False)
+    flags = tab['lab_collection_days_since_birth_censored']
+
+    assert tab.schema.field('lab_collection_days_since_birth').type == pa.int32()
+    assert flags.type == pa.bool_()
+    assert not t.sel(cache=False,lab_component_name=t.unique(count=False)).lab_collection_days_since_birth_censored.any()
+
+def test_categorical():
+    t = get_table('Table2_Flowsheet.csv')
+    df = t.sel(display_name=['HEIGHT','WEIGHT'])
+
+    assert isinstance(df.display_name.dtype,pd.CategoricalDtype)
+    assert set(df.display_name.cat.categories) <= {'HEIGHT','WEIGHT'}
+    assert not isinstance(t.sel(display_name=['HEIGHT'],categorical=False).display_name.dtype,pd.CategoricalDtype)
+    assert isinstance(tidy_flow(df).name.dtype,pd.CategoricalDtype)
+
+    tidy = tidy_flow(t.scan(display_name=['HEIGHT']))
+    assert isinstance(tidy.name.dtype,pd.CategoricalDtype)
+    assert list(tidy.name.cat.categories) == ['HEIGHT']
+
+def write_flowsheet(tmp_path):
+    rows = ['{},{},10:0{}:00,{},{}'.format(1000+i%6, 25737+i%3 if i != 7 else '>32871', i%10, ['PULSE','Height','WEIGHT'][i%3], 60+i) for i in range(30)]
+    fp = tmp_path/'Table2_Flowsheet.csv'
+    fp.write_text('encounter_id,flowsheet_days_since_birth,flowsheet_time,display_name,flowsheet_value\n'+'\n'.join(rows)+'\n')
+    return str(fp)
+
+def sorted_sel(t, **kwargs):
+    df = t.sel(categorical=False, **kwargs)[t.schema.names]
+    return df.sort_values(['encounter_id','display_name','flowsheet_value']).reset_index(drop=True)
+
+def test_parquet_cache(tmp_path):
+    t = Table(write_flowsheet(tmp_path), table_cache=TableCache(max_bytes=0))
+    queries = [{'display_name':['HEIGHT','PULSE']}, {'display_name':['WEIGHT'],'encounter_id':[1002,1004]}]
+    expected = [sorted_sel(t, cache=False, **q) for q in queries]
+    assert all(len(e) > 0 for e in expected)
+
+    t.build_parquet_cache(row_group_size=4)
+    with pytest.raises(IOError):
+        t.build_parquet_cache()
+    for q,e in zip(queries, expected):
+        assert sorted_sel(t, **q).equals(e)
+
+    os.remove(t._cache_path('.parquet'))
+    t.partition()
+    assert t.scan().column_names == t.schema.names
+    assert all(b.column_names == t.schema.names for b in t.iter_sel(display_name=['PULSE']))
+    for q,e in zip(queries, expected):
+        assert sorted_sel(t, **q).equals(e)
+
+def test_encounter_layout(tmp_path):
+    t = Table(write_flowsheet(tmp_path), table_cache=TableCache(max_bytes=0))
+    query = {'display_name':['HEIGHT','WEIGHT'],'encounter_id':[1001,1002]}
+    t.build_parquet_cache(row_group_size=4)
+    expected = sorted_sel(t, **query)
+    assert not os.path.exists(t._index_path())
+
+    t.build_parquet_cache(row_group_size=4, layout='encounter', overwrite=True)
+    assert os.path.exists(t._index_path())
+    row_groups = t._indexed_row_groups(encounter_id=[1001,1002])
+    assert 0 < len(row_groups) < pq.ParquetFile(t._cache_path('.parquet')).metadata.num_row_groups
+    assert sorted_sel(t, **query).equals(expected)
+
+    # Rewriting the parquet file leaves the index stale, it's rebuilt on the next query
+    pq.write_table(pq.read_table(t._cache_path('.parquet')), t._cache_path('.parquet'), row_group_size=8)
+    assert sorted_sel(t, **query).equals(expected)
+    assert t._indexed_row_groups(encounter_id=[1001,1002]) is not None
+    assert json.load(open(t._index_path()))['source_mtime'] == os.path.getmtime(t._cache_path('.parquet'))
+    assert len(json.load(open(t._index_path()))['encounter_id']) == pq.ParquetFile(t._cache_path('.parquet')).metadata.num_row_groups
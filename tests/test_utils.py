@@ -0,0 +1,141 @@
+import pytest
+import numpy as np
+import pandas as pd
+from tricorder.utils import resample, RESAMPLE_AGGS, pivot_tidy, melt_tidy, search
+
+def tidy_frame():
+    return pd.DataFrame({
+        'encounter_id' : [1,1,1,1,2],
+        'time' : pd.to_timedelta(['0h10m','0h50m','2h20m','0h30m','1h40m']),
+        'name' : pd.Categorical(['HR','HR','HR','SBP','HR']),
+        'value' : [60.,80.,100.,120.,70.],
+    })
+
+def grid(df):
+    return {(e,t/pd.Timedelta('1h')): row.tolist() for (e,t),row in df.iterrows()}
+
+def test_resample_floor():
+    r = resample(tidy_frame(), '1h')
+    assert list(r.columns) == ['HR','SBP']
+    assert r.index.names == ['encounter_id','time']
+    # Every bin between an encounter's first and last observation, empty bins are NaN
+    np.testing.assert_equal(grid(r), {
+        (1,0.) : [70.,120.],
+        (1,1.) : [np.nan,np.nan],
+        (1,2.) : [100.,np.nan],
+        (2,1.) : [70.,np.nan],
+    })
+
+def test_resample_round():
+    r = resample(tidy_frame(), '1h', how='round')
+    np.testing.assert_equal(grid(r), {
+        (1,0.) : [60.,np.nan],
+        (1,1.) : [80.,120.],
+        (1,2.) : [100.,np.nan],
+        (2,2.) : [70.,np.nan],
+    })
+
+def test_resample_origin():
+    r = resample(tidy_frame(), '1h', origin='start')
+    # Bins are labelled from each encounter's own first bin
+    assert [t/pd.Timedelta('1h') for t in r.index.get_level_values('time')] == [0.,1.,2.,0.]
+    np.testing.assert_array_equal(r.to_numpy(), resample(tidy_frame(), '1h').to_numpy())
+
+def test_resample_fill():
+    r = resample(tidy_frame(), '1h', fill='ffill')
+    # Values are carried forward within an encounter but never into the next one
+    np.testing.assert_equal(grid(r), {
+        (1,0.) : [70.,120.],
+        (1,1.) : [70.,120.],
+        (1,2.) : [100.,120.],
+        (2,1.) : [70.,np.nan],
+    })
+
+    df = tidy_frame()
+    df.loc[2,'time'] = pd.Timedelta('3h20m')
+    r = resample(df, '1h', fill='ffill', limit=1)
+    np.testing.assert_equal(grid(r)[(1,1.)], [70.,120.])
+    np.testing.assert_equal(grid(r)[(1,2.)], [np.nan,np.nan])
+    np.testing.assert_equal(grid(r)[(1,3.)], [100.,np.nan])
+
+def test_resample_aggs():
+    r = resample(tidy_frame(), '1h', agg=['min','max','count'])
+    assert list(r.columns) == [(n,a) for n in ['HR','SBP'] for a in ['min','max','count']]
+    assert r.loc[(1,pd.Timedelta('0h')),'HR'].tolist() == [60.,80.,2.]
+    assert r.loc[(1,pd.Timedelta('1h')),('HR','count')] == 0
+    assert r.equals(resample(tidy_frame(), '1h', agg={'value':['min','max','count']}))
+    with pytest.raises(AssertionError):
+        resample(tidy_frame(), '1h', agg='median')
+
+@pytest.mark.parametrize('agg', RESAMPLE_AGGS)
+def test_resample_matches_pandas(agg):
+    rng = np.random.default_rng(0)
+    n = 500
+    df = pd.DataFrame({
+        'encounter_id' : rng.integers(0,5,n),
+        'time' : pd.to_timedelta(rng.integers(0,48*60,n), unit='min'),
+        'name' : pd.Categorical(rng.choice(['HR','SBP','SPO2'],n)),
+        'value' : rng.normal(size=n).round(2),
+    })
+    r = resample(df, '4h', agg=agg)
+    counts = resample(df, '4h', agg='count')
+
+    epoch = pd.Timestamp(0)
+    for (e,name),g in df.groupby(['encounter_id','name'], observed=True):
+        # DataFrame.resample on epoch anchored times, bins are aligned to t == 0 like resample's
+        expected = g.set_index(epoch + g.time).sort_index(kind='stable').value.resample('4h', origin='epoch').agg(agg)
+        expected.index = expected.index - epoch
+        got = r.loc[e,name].reindex(expected.index)
+        observed = counts.loc[e,name].reindex(expected.index) > 0
+        np.testing.assert_allclose(got[observed], expected[observed])
+
+def test_pivot_melt_round_trip():
+    # Unsorted rows, duplicate timestamps and a category without any values
+    df = pd.DataFrame({
+        'encounter_id' : [2,1,1,1,1,2,1],
+        'time' : pd.to_timedelta([0,60,0,0,60,0,120], unit='min'),
+        'name' : pd.Categorical(['HR','HR','HR','HR','SBP','SBP','HR'], categories=['HR','RR','SBP']),
+        'value' : [70.,80.,60.,64.,120.,110.,np.nan],
+    })
+    wide = pivot_tidy(df)
+    expected = df.pivot_table(index=['encounter_id','time'], values='value', aggfunc='mean', columns='name', observed=True)
+    assert list(wide.columns) == list(expected.columns) == ['HR','SBP']
+    assert wide.index.equals(expected.index)
+    np.testing.assert_allclose(wide.to_numpy(), expected.to_numpy())
+    assert wide.loc[(1,pd.Timedelta(0)),'HR'] == 62.
+
+    long = melt_tidy(wide, t='time')
+    assert list(long.columns) == ['encounter_id','time','name','value']
+    assert isinstance(long.name.dtype, pd.CategoricalDtype)
+    # Every (encounter_id, time) cell comes back, the ones without a value as NaN
+    assert len(long) == wide.size
+    means = df.dropna().groupby(['encounter_id','time','name'], observed=True).value.mean()
+    got = long.dropna().set_index(['encounter_id','time','name']).value.sort_index()
+    np.testing.assert_allclose(got.to_numpy(), means.sort_index().to_numpy())
+    assert got.index.tolist() == means.sort_index().index.tolist()
+    assert pivot_tidy(long.dropna()).equals(wide)
+
+NAMES = pd.Series(['HEART RATE','Heart Rhythm','PULSE','PULSE OX','CARDIAC OUTPUT','CCO (L/MIN)',None,'HEART RATE'], index=range(10,18))
+
+def contains(patterns, regex=False, ignore_case=False):
+    # The pandas str.contains behaviour search replaced
+    mask = np.zeros(len(NAMES), dtype=bool)
+    for p in patterns:
+        mask |= NAMES.str.contains(p, regex=regex, case=not ignore_case, na=False).to_numpy()
+    return NAMES[mask]
+
+@pytest.mark.parametrize('q,regex,ignore_case', [
+    ('PULSE', False, False),
+    ('heart', False, True),
+    ('(L/MIN)', False, False),
+    ('^PULSE$', True, False),
+    ('^heart r', True, True),
+    (['PULSE OX','CARDIAC'], False, False),
+    (['rate','(l/'], False, True),
+    (['^CCO','RATE$'], True, False),
+])
+def test_search(q, regex, ignore_case):
+    patterns = [q] if isinstance(q, str) else q
+    found = search(q, NAMES, regex=regex, ignore_case=ignore_case)
+    assert len(found) > 0
+    assert found.equals(contains(patterns, regex=regex, ignore_case=ignore_case))
@@ -0,0 +1,154 @@
+"""Charlson comorbidity categories, ICD-10 coding algorithm of Quan et al. (Med Care 2005)
+
+Entries are code prefixes, e.g. 'I50' covers every I50.x code.
+"""
+from .codesets_ICD10 import code_range
+
+myocardial_infarction = [
+    'I21','I22','I25.2',
+]
+
+congestive_heart_failure = [
+    'I09.9','I11.0','I13.0','I13.2','I25.5','I42.0',
+    *code_range('I42.5','I42.9'),
+    'I43','I50','P29.0',
+]
+
+peripheral_vascular_disease = [
+    'I70','I71','I73.1','I73.8','I73.9','I77.1','I79.0','I79.2',
+    'K55.1','K55.8','K55.9','Z95.8','Z95.9',
+]
+
+cerebrovascular_disease = [
+    'G45','G46','H34.0',
+    *code_range('I60','I69'),
+]
+
+dementia = [
+    *code_range('F00','F03'),
+    'F05.1','G30','G31.1',
+]
+
+chronic_pulmonary_disease = [
+    'I27.8','I27.9',
+    *code_range('J40','J47'),
+    *code_range('J60','J67'),
+    'J68.4','J70.1','J70.3',
+]
+
+rheumatic_disease = [
+    'M05','M06','M31.5',
+    *code_range('M32','M34'),
+    'M35.1','M35.3','M36.0',
+]
+
+peptic_ulcer_disease = [
+    *code_range('K25','K28'),
+]
+
+mild_liver_disease = [
+    'B18',
+    *code_range('K70.0','K70.3'),
+    'K70.9',
+    *code_range('K71.3','K71.5'),
+    'K71.7','K73','K74','K76.0',
+    *code_range('K76.2','K76.4'),
+    'K76.8','K76.9','Z94.4',
+]
+
+diabetes_uncomplicated = [
+    code for e in code_range('E10','E14') for code in [e+'.0', e+'.1', e+'.6', e+'.8', e+'.9']
+]
+
+diabetes_complicated = [
+    code for e in code_range('E10','E14') for code in [*code_range(e+'.2', e+'.5'), e+'.7']
+]
+
+hemiplegia_paraplegia = [
+    'G04.1','G11.4','G80.1','G80.2','G81','G82',
+    *code_range('G83.0','G83.4'),
+    'G83.9',
+]
+
+renal_disease = [
+    'I12.0','I13.1',
+    *code_range('N03.2','N03.7'),
+    *code_range('N05.2','N05.7'),
+    'N18','N19','N25.0',
+    *code_range('Z49.0','Z49.2'),
+    'Z94.0','Z99.2',
+]
+
+malignancy = [
+    *code_range('C00','C26'),
+    *code_range('C30','C34'),
+    *code_range('C37','C41'),
+    'C43',
+    *code_range('C45','C58'),
+    *code_range('C60','C76'),
+    *code_range('C81','C85'),
+    'C88',
+    *code_range('C90','C97'),
+]
+
+severe_liver_disease = [
+    'I85.0','I85.9','I86.4','I98.2','K70.4','K71.1','K72.1','K72.9',
+    'K76.5','K76.6','K76.7',
+]
+
+metastatic_solid_tumor = [
+    *code_range('C77','C80'),
+]
+
+aids_hiv = [
+    *code_range('B20','B22'),
+    'B24',
+]
+
+categories = {
+    'myocardial_infarction' : myocardial_infarction,
+    'congestive_heart_failure' : congestive_heart_failure,
+    'peripheral_vascular_disease' : peripheral_vascular_disease,
+    'cerebrovascular_disease' : cerebrovascular_disease,
+    'dementia' : dementia,
+    'chronic_pulmonary_disease' : chronic_pulmonary_disease,
+    'rheumatic_disease' : rheumatic_disease,
+    'peptic_ulcer_disease' : peptic_ulcer_disease,
+    'mild_liver_disease' : mild_liver_disease,
+    'diabetes_uncomplicated' : diabetes_uncomplicated,
+    'diabetes_complicated' : diabetes_complicated,
+    'hemiplegia_paraplegia' : hemiplegia_paraplegia,
+    'renal_disease' : renal_disease,
+    'malignancy' : malignancy,
+    'severe_liver_disease' : severe_liver_disease,
+    'metastatic_solid_tumor' : metastatic_solid_tumor,
+    'aids_hiv' : aids_hiv,
+}
+
+# Charlson et al. (J Chronic Dis 1987) weights
+weights = {
+    'myocardial_infarction' : 1,
+    'congestive_heart_failure' : 1,
+    'peripheral_vascular_disease' : 1,
+    'cerebrovascular_disease' : 1,
+    'dementia' : 1,
+    'chronic_pulmonary_disease' : 1,
+    'rheumatic_disease' : 1,
+    'peptic_ulcer_disease' : 1,
+    'mild_liver_disease' : 1,
+    'diabetes_uncomplicated' : 1,
+    'diabetes_complicated' : 2,
+    'hemiplegia_paraplegia' : 2,
+    'renal_disease' : 2,
+    'malignancy' : 2,
+    'severe_liver_disease' : 3,
+    'metastatic_solid_tumor' : 6,
+    'aids_hiv' : 6,
+}
+
+# (category, superseded by) pairs, only the more severe category counts towards the score
+hierarchy = [
+    ('mild_liver_disease', 'severe_liver_disease'),
+    ('diabetes_uncomplicated', 'diabetes_complicated'),
+    ('malignancy', 'metastatic_solid_tumor'),
+]
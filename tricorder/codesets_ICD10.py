@@ -1,3 +1,5 @@
+import os
+
 cad = [
     'I25.10',
     'I25.110',
@@ -60,4 +62,13 @@ stroke = [
  'I65.21',
  'I65.22',
  'I65.23',
- 'I65.29']
\ No newline at end of file
+ 'I65.29']
+
+def code_range(start, stop):
+    """ICD-10 codes from start to stop inclusive, e.g. code_range('I42.5','I42.9') or code_range('C00','C26')"""
+    assert len(start) == len(stop), 'range ends must have the same length'
+    i = len(os.path.commonprefix([start, stop]))
+    while i > 0 and start[i-1].isdigit():
+        i -= 1
+    width = len(start) - i
+    return ['{}{:0{}d}'.format(start[:i], n, width) for n in range(int(start[i:]), int(stop[i:])+1)]
@@ -1,12 +1,13 @@
 import numpy as np
 import pandas as pd
-from tqdm.auto import tqdm
 from tableone import TableOne
 import os
 import json
+import functools
+from collections import namedtuple
 from .utils import tidy_labs, tidy_flow, tidy_procs
-from .outcome_utils import mpog_aki,aki_code_map
-from .codesets_ICD10 import cad,stroke
+from .outcome_utils import mpog_aki_frame,aki_code_map
+from .comorbidities import flag_comorbidities, score_comorbidities
 from .tables import SEARCH_COLS
 
 blood_product_names = [
@@ -22,6 +23,44 @@ blood_product_names = [
     'TRANSFUSE PLATELETS: 2 UNITS',
 ]
 
+GENDER_LABELS = {1:'Male', 2:'Female'}
+
+# Factors converting heights to metres and weights to kilograms
+BMI_UNITS = {
+    'm' : 1.0,
+    'cm' : 0.01,
+    'in' : 0.0254,
+    'kg' : 1.0,
+    'g' : 0.001,
+    'lb' : 0.45359237,
+    'oz' : 0.028349523125,
+}
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'currsize'])
+
+def memoize(func):
+    """Memoizes a cohort accessor on (accessor, encounter ids, offset version)
+
+    Results are returned as copies so callers can't mutate the cached frame. Calls
+    with unhashable arguments skip the cache.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            key = (func.__name__, self._eid_key(), self._offset_version, args, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return func(self, *args, **kwargs)
+
+        if key in self._memo:
+            self._memo_hits += 1
+        else:
+            self._memo_misses += 1
+            self._memo[key] = func(self, *args, **kwargs)
+        result = self._memo[key]
+        return result.copy() if hasattr(result, 'copy') else result
+    return wrapper
+
 def cohort_tableone(co,missing=True,overall=True,**kwargs):
     kwargs['missing'] = missing
     kwargs['overall'] = overall
@@ -39,6 +78,68 @@ def cohort_tableone(co,missing=True,overall=True,**kwargs):
     tab1 = TableOne(t1,columns=t1.columns[1:].tolist(),**kwargs)
     return tab1
 
+class FetchPlan(object):
+    """Unions the data requirements of a cohort and its metrics so each table is only scanned once
+
+    Tables are read lazily on the first request, restricted to the cohort's encounters
+    and the union of required names, and every later request covered by the plan is
+    served as a filtered view of that single read.
+
+    Parameters
+    ----------
+    db : SWAN or TAVR
+        Database the tables are read from
+    encounter_id : array-like
+        Encounters of the cohort
+    required : dict
+        Table attribute name (e.g. 'labs') to list of required search column values
+    """
+    def __init__(self, db, encounter_id, required):
+        self.db = db
+        self.encounter_id = np.asarray(encounter_id)
+        self.update(required)
+
+    def __repr__(self):
+        return 'FetchPlan({})'.format({k:len(v) for k,v in self.required.items()})
+
+    def update(self, required):
+        """Replaces the requirements, dropping any tables read for the old ones"""
+        self.required = {k:set(v) for k,v in required.items() if hasattr(self.db,k)}
+        self.tables = {}
+
+    def covers(self, table, encounter_id=None, **kwargs):
+        """Whether a sel(encounter_id, **kwargs) against table can be answered from the plan"""
+        if table not in self.required or encounter_id is None:
+            return False
+        search_col = getattr(self.db,table).search_col
+        if list(kwargs.keys()) != [search_col]:
+            return False
+        return set(kwargs[search_col]) <= self.required[table] and np.isin(encounter_id, self.encounter_id).all()
+
+    def _load(self, table):
+        if table not in self.tables:
+            t = getattr(self.db,table)
+            query = {
+                'encounter_id':self.encounter_id,
+                t.search_col : list(self.required[table]),
+            }
+            self.tables[table] = t.sel(**query)
+        return self.tables[table]
+
+    def sel(self, table, encounter_id=None, **kwargs):
+        """Drop in for db.<table>.sel that answers from the plan whenever it covers the request"""
+        if not self.covers(table, encounter_id, **kwargs):
+            return getattr(self.db,table).sel(encounter_id=encounter_id, **kwargs)
+
+        df = self._load(table)
+        search_col = getattr(self.db,table).search_col
+        mask = df[search_col].isin(kwargs[search_col]) & df.encounter_id.isin(encounter_id)
+        df = df[mask].copy()
+        # Views only keep the categories present, like a direct sel
+        for c in df.select_dtypes('category').columns:
+            df[c] = df[c].cat.remove_unused_categories()
+        return df
+
 class CohortMetrics(object):
     def __init__(self):
         self.metrics = []
@@ -93,10 +194,28 @@ class ProcedureCohort(object):
         self.eid = self.encounter_info.encounter_id.unique()
         self.pid = self.encounter_info.person_id.unique()
         self.encounters = self.eid
+        self.demographics = self._demographics()
 
         self._offset = self._enc_series(self.procedure_info, 'days_from_dob_procstart','offset').astype(int)
         self.offset = self._offset
         self.metrics = CohortMetrics()
+        self.plan = FetchPlan(self.db, self.eid, self._find_required_data())
+
+        self._offset_version = 0
+        self.clear_cache()
+
+    def _eid_key(self):
+        return hash(np.sort(np.asarray(self.eid)).tobytes())
+
+    def cache_info(self):
+        """Returns hits, misses and number of memoized cohort accessor results"""
+        return CacheInfo(self._memo_hits, self._memo_misses, len(self._memo))
+
+    def clear_cache(self):
+        """Drops all memoized cohort accessor results"""
+        self._memo = {}
+        self._memo_hits = 0
+        self._memo_misses = 0
         
     def _find_required_data(self):
         from tricorder.procedure_codesets import icu_codes, room_codes
@@ -104,7 +223,7 @@ class ProcedureCohort(object):
 
         required = {
             'labs':['CREATININE SERUM','TROPONIN I'],
-            'flowsheet':[],
+            'flowsheet':['HEIGHT','WEIGHT'],
             'procedures':proc_codes,
         }
         
@@ -112,7 +231,7 @@ class ProcedureCohort(object):
             required_vars = m.__class__.REQUIRES
             for k,v in required_vars.items():
                 if hasattr(self.db,k):
-                    required[k].extend(required_vars[k])
+                    required.setdefault(k,[]).extend(required_vars[k])
             
         required = {k:pd.Series(v).unique().tolist() for k,v in required.items()}
         return required
@@ -122,6 +241,8 @@ class ProcedureCohort(object):
         assert 'offset' in df.columns
         
         self.offset = df[['encounter_id','offset']]
+        self._offset_version += 1
+        self.clear_cache()
         print('updated offset to:')
         return self.offset.head()
     
@@ -161,6 +282,10 @@ class ProcedureCohort(object):
         m = metric(db=self.db, encounter_id=self.eid)
         self.metrics.metrics.append(m)
         m.__attach__(self.metrics)
+
+        # Every attached metric shares one plan so each table is scanned once for all of them
+        self.plan.update(self._find_required_data())
+        m.plan = self.plan
         return self.metrics
     
     def align_metric(self,df,time_column='time',events=None):
@@ -183,23 +308,28 @@ class ProcedureCohort(object):
         df.time = df.time - pd.to_timedelta(df.offset,unit='day')
         return df
     
+    def _demographics(self):
+        """One row per encounter of the columns behind the demographic accessors, genders labelled"""
+        d = self.encounter_info[['encounter_id','person_id','age','gender','death_during_encounter']].drop_duplicates('encounter_id')
+        return d.assign(gender=d.gender.map(GENDER_LABELS)).reset_index(drop=True)
+
     @property
+    @memoize
     def age(self):
-        s = self.encounter_info
-        return self._enc_series(s,'age')
+        return self._enc_series(self.demographics,'age')
         
     def labs(self,names,dropna=True):
-        labs = self.db.labs.sel(lab_component_name=names,encounter_id=self.eid)
+        labs = self.plan.sel('labs', lab_component_name=names, encounter_id=self.eid)
 
         return tidy_labs(labs)
 
     def flowsheet(self,names, dropna=True, to_numeric=True):
-        tab = self.db.flowsheet.sel(display_name=names,encounter_id=self.eid)
+        tab = self.plan.sel('flowsheet', display_name=names, encounter_id=self.eid)
 
         return tidy_flow(tab, to_numeric=to_numeric)
     
     def procs(self, names, dropna=True):
-        tab = self.db.procedures.sel(order_name=names,encounter_id=self.eid)
+        tab = self.plan.sel('procedures', order_name=names, encounter_id=self.eid)
 
         return tidy_procs(tab)
         
@@ -215,40 +345,33 @@ class ProcedureCohort(object):
         return labs
     
     @property
+    @memoize
     def mortality(self):
-        return self._enc_series(self.encounter_info,'death_during_encounter', 'death')
+        return self._enc_series(self.demographics,'death_during_encounter', 'death')
 
     @property
+    @memoize
     def gender(self):
-        s = self.encounter_info.groupby('encounter_id').apply(
-            lambda r: r.gender.replace({1:'Male',2:'Female'})
-        ).reset_index()
-        return self._enc_series(s,'gender')
+        return self._enc_series(self.demographics,'gender')
 
     @property
+    @memoize
     def male_gender(self):
-        s = self.encounter_info.groupby('encounter_id').apply(
-            lambda r: r.gender.replace({1:'Male',2:np.nan})
-        ).reset_index()
-        return self._enc_series(s,'gender','male gender')
+        d = self.demographics
+        return self._enc_series(d.assign(gender=d.gender.where(d.gender == 'Male')),'gender','male gender')
     
+    @memoize
     def postop_aki(self,method='mpog'):
         """Postop AKI
         Generates labels for whether or not the patient had AKI out to 7days postop
         """
         scr = self.labs(['CREATININE SERUM']).query('value <= 25 and value >= 0.2').reset_index()
         scr = self.align_metric(scr)
-        grouper  = scr.groupby('encounter_id')
-        pbar = tqdm(grouper)
-        aki = []
-        pbar.set_description('postop_aki')
-        for _,e in pbar:
-            result = mpog_aki(e,result_col='value')
-            aki.append(result)
-        aki = pd.DataFrame({'encounter_id':scr.encounter_id.unique(),'value':aki})
-        aki['desc'] = aki.value.apply(lambda d: aki_code_map[d])
+        aki = mpog_aki_frame(scr,result_col='value')
+        aki['desc'] = aki.value.map(aki_code_map)
         return aki
     
+    @memoize
     def postop_troponin(self, max_days=3):
         """Postop Troponin (I or T)
         Returns peak troponin value in the post op period parameterized by max_days
@@ -262,6 +385,7 @@ class ProcedureCohort(object):
         trp_hi = self.offset.merge(trp_hi,on=['encounter_id','offset'],how='left')
         return trp_hi
     
+    @memoize
     def postop_los(self):
         """Postop length of stay
         """
@@ -272,10 +396,12 @@ class ProcedureCohort(object):
         return self._enc_series(c,'postop_los')
     
     @property
+    @memoize
     def delirium(self):
         c = self.db.flowsheet.sel(display_name=['CAM ICU'],encounter_id=self.eid)
         return tidy_flow(c, to_numeric=False)
 
+    @memoize
     def get_post_op_delirium(self, detail='full', clean=True):
         # c = self.delirium.query('day >= 0.0')
         c = self.delirium
@@ -313,15 +439,18 @@ class ProcedureCohort(object):
         return rooms
     
     @property
+    @memoize
     def room_changes(self):
         from tricorder.procedure_codesets import room_codes
-        rooms = self.db.procedures.sel(order_name=room_codes,encounter_id=self.eid)
+        rooms = self.plan.sel('procedures', order_name=room_codes, encounter_id=self.eid)
         rooms = rooms.pivot_table(index=['encounter_id','days_from_dob_procstart'],columns='order_name',values='person_id',
-                                  aggfunc='count')
+                                  aggfunc='count', observed=True)
+        rooms.columns = rooms.columns.astype(str)
         rooms = rooms.reset_index().astype({'days_from_dob_procstart':int})
         return rooms        
     
     @property
+    @memoize
     def reexploration_for_bleed(self):
         re_exp_procedures = [
                 'CONTROL BLEEDING IN MEDIASTINUM, OPEN APPROACH',
@@ -345,35 +474,68 @@ class ProcedureCohort(object):
         return self._enc_series(re_exp,'reexploration_for_bleed')
     
     @property
+    @memoize
     def bmi(self):
-        c = self.db.flowsheet.sel(
-            encounter_id=self.eid,
-            pivot=True,
-            display_name=['HEIGHT','WEIGHT']
-        ).reset_index().drop(columns=['flowsheet_days_since_birth']).drop_duplicates()
-        c = c.groupby('encounter_id').apply(np.mean).drop(columns='encounter_id').reset_index()
-        c['BMI'] = c['WEIGHT']/c['HEIGHT']
-        c = self.encounter_info.merge(c[['encounter_id','BMI']],how='left',on='encounter_id')
-        return self._enc_series(c, 'BMI')
+        return self.get_bmi()
 
+    @memoize
+    def get_bmi(self, nearest=False, height_unit=None, weight_unit=None):
+        """Body mass index per encounter from HEIGHT and WEIGHT flowsheet rows
+
+        Measurements are averaged per day then across days with grouped means on the
+        long rows, without pivoting the flowsheet.
+
+        Parameters
+        ----------
+        nearest : bool
+            Only use the measurements closest in time to the cohort offset
+        height_unit : str, optional
+            Unit of HEIGHT values, a key of BMI_UNITS (e.g. 'in', 'cm')
+        weight_unit : str, optional
+            Unit of WEIGHT values, a key of BMI_UNITS (e.g. 'oz', 'kg'). When both units are
+            given values are converted to kg / m^2, otherwise BMI is the raw WEIGHT / HEIGHT ratio
+
+        Returns
+        -------
+        pd.DataFrame
+            encounter_id and BMI
+        """
+        assert (height_unit is None) == (weight_unit is None), 'give both height_unit and weight_unit'
+        c = self.align_metric(self.flowsheet(['HEIGHT','WEIGHT']))
+        if nearest:
+            dist = c.time.abs()
+            c = c[dist == dist.groupby([c.encounter_id, c.name], observed=True).transform('min')]
+        c['day'] = c.time.dt.floor('D')
+        c = c.groupby(['encounter_id','name','day'], observed=True).value.mean()
+        c = c.groupby(level=['encounter_id','name'], observed=True).mean().unstack().reindex(columns=['HEIGHT','WEIGHT'])
+
+        if height_unit is None:
+            bmi = c.WEIGHT / c.HEIGHT
+        else:
+            bmi = c.WEIGHT*BMI_UNITS[weight_unit] / (c.HEIGHT*BMI_UNITS[height_unit])**2
+        return self.demographics[['encounter_id']].merge(bmi.rename('BMI').reset_index(), how='left', on='encounter_id')
+
+    @memoize
     def post_op_icu_days(self):
         from tricorder.procedure_codesets import icu_codes
-        c = self.db.procedures.sel(encounter_id=self.eid,order_name=icu_codes)
+        c = self.plan.sel('procedures', encounter_id=self.eid, order_name=icu_codes)
         # c = c.merge(self.offset,how='left').drop_duplicates()
         return c.groupby(['encounter_id','days_from_dob_procstart']).count()
 
     @property
+    @memoize
     def ckd(self):
         l = self.db.labs.sel(lab_component_name=self.db.labs.search('GFR').values, encounter_id=self.eid)
-        l = co.align_metric(l)
+        l = self.align_metric(l)
         l['days'] = l.time/np.timedelta64(1,'D')
         ckd = l.query('days < 1 & days > -3').groupby('encounter_id').apply(lambda d: (d.value<60).any()).rename('ckd').reset_index()
         
         return ckd
     @property
+    @memoize
     def icu_start(self):
         from tricorder.procedure_codesets import icu_codes
-        c = self.db.procedures.sel(encounter_id=self.eid,order_name=icu_codes)
+        c = self.plan.sel('procedures', encounter_id=self.eid, order_name=icu_codes)
         c = c.merge(self.offset,how='left').astype({'offset':int})
         c['day'] = c.days_from_dob_procstart.astype(int) - c.offset
         c = c[c.day>=0]
@@ -382,14 +544,16 @@ class ProcedureCohort(object):
         return c.groupby('encounter_id')['offset'].min().reset_index()
 
     @property
+    @memoize
     def icu_los(self):
         from tricorder.procedure_codesets import icu_codes
-        c = self.db.procedures.sel(encounter_id=self.eid,order_name=icu_codes)
+        c = self.plan.sel('procedures', encounter_id=self.eid, order_name=icu_codes)
         c = c.merge(self.offset,how='left')
         c['ICU LOS'] = c.days_from_dob_procstart.astype(int) - c.offset
         c = self.encounter_info.merge(c[['encounter_id','ICU LOS']],how='left',on='encounter_id')
         return c.groupby('encounter_id')['ICU LOS'].max().sort_index().to_frame().reset_index()
         
+    @memoize
     def blood_products(self,kind='RBC'):
         bp = self.db.transfusion.sel(
             transfusion_name=self.db.transfusion.search('TRANSFUSE {}:'.format(kind)), 
@@ -402,6 +566,7 @@ class ProcedureCohort(object):
         return self._enc_series(bp,'UNITS {}'.format(kind))
     
     @property
+    @memoize
     def mechanical_ventilation_duration(self):
         c = self.db.flowsheet.sel(
             encounter_id=self.eid,
@@ -414,53 +579,76 @@ class ProcedureCohort(object):
         return c.groupby('encounter_id')['days'].max().sort_index().to_frame().reset_index()
 
     @property
-    def osa(self, code_type='ICD-10'):
-        osa_codes = ['UNSPECIFIED SLEEP APNEA', 'SLEEP APNEA, UNSPECIFIED']
-        c = self.db.diagnosis.sel(
-            person_id=self.pid,
-            CodeType=[code_type+'-CM'],
-        )
-        c = c.groupby('person_id').CodeDescription.apply(lambda s:s.isin(osa_codes).any()).reset_index()
-        c = self.encounter_info.merge(c[['person_id','CodeDescription']],how='left',on='person_id').drop_duplicates()
-        return self._enc_series(c,'CodeDescription','OSA')
+    @memoize
+    def diagnoses(self):
+        return self.db.diagnosis.sel(person_id=self.pid, columns=['person_id','Code','CodeDescription','CodeType'])
+
+    def comorbidities(self, concepts=None):
+        """Boolean comorbidity flags per encounter from a single scan of the diagnosis table
+
+        Parameters
+        ----------
+        concepts : list of str, optional
+            Keys of comorbidities.CONCEPTS, defaults to all of them
+
+        Returns
+        -------
+        pd.DataFrame
+            encounter_id and one boolean column per concept
+        """
+        flags = flag_comorbidities(self.diagnoses, concepts)
+        c = self.encounter_info[['encounter_id','person_id']].merge(flags, how='left', left_on='person_id', right_index=True)
+        c[flags.columns] = c[flags.columns].fillna(False).astype(bool)
+        return c.drop(columns='person_id').drop_duplicates().reset_index(drop=True)
+
+    @memoize
+    def comorbidity_index(self, index='elixhauser'):
+        """Elixhauser or Charlson comorbidity categories and weighted score per encounter
+
+        Scores are computed for the whole diagnosis table in one streaming pass and
+        cached on disk until it changes (see comorbidities.score_comorbidities).
+
+        Parameters
+        ----------
+        index : str
+            'elixhauser' (van Walraven weights) or 'charlson'
+
+        Returns
+        -------
+        pd.DataFrame
+            encounter_id, one boolean column per category and the weighted score
+        """
+        scores = score_comorbidities(self.db.diagnosis, index)
+        c = self.encounter_info[['encounter_id','person_id']].merge(scores, how='left', left_on='person_id', right_index=True)
+        categories = scores.columns.drop('score')
+        c[categories] = c[categories].fillna(False).astype(bool)
+        c['score'] = c.score.fillna(0).astype(int)
+        return c.drop(columns='person_id').drop_duplicates().reset_index(drop=True)
+
+    @property
+    @memoize
+    def osa(self):
+        return self._enc_series(self.comorbidities(['osa']),'osa','OSA')
 
     @property
-    def cad(self, code_type='ICD-10-CM'):
-        c = self.db.diagnosis.sel(person_id=self.pid)
-        c = c.groupby('person_id').Code.apply(lambda s: s.isin(cad).any()).rename('value')
-        c = self.encounter_info.merge(c.reset_index(),how='left',on='person_id').drop_duplicates().astype({'value':int})
-        return self._enc_series(c,'value','CAD')
+    @memoize
+    def cad(self):
+        return self._enc_series(self.comorbidities(['cad']).astype({'cad':int}),'cad','CAD')
     
     @property
-    def chf(self, code_type='ICD-10'):
-        chf_codes = self.db.diagnosis.search('HEART FAILURE').unique()
-        code_map = {k:v for k,v in zip(chf_codes,[True]*len(chf_codes))}
-        c = self.db.diagnosis.sel(
-            person_id=self.pid,
-            CodeType=[code_type+'-CM'],
-        )
-        c = c.groupby('person_id').CodeDescription.apply(lambda s:s.isin(chf_codes).any()).reset_index()
-        c = self.encounter_info.merge(c[['person_id','CodeDescription']],how='left',on='person_id').drop_duplicates()
-        return self._enc_series(c,'CodeDescription','CHF')
+    @memoize
+    def chf(self):
+        return self._enc_series(self.comorbidities(['chf']),'chf','CHF')
 
     @property
-    def dm(self, code_type='ICD-10'):
-        dm_codes = self.db.diagnosis.search('DIABETES').unique()
-        code_map = {k:v for k,v in zip(dm_codes,[True]*len(dm_codes))}
-        c = self.db.diagnosis.sel(
-            person_id=self.pid,
-            CodeType=[code_type+'-CM'],
-        )
-        c = c.groupby('person_id').CodeDescription.apply(lambda s:s.isin(dm_codes).any()).reset_index()
-        c = self.encounter_info.merge(c[['person_id','CodeDescription']],how='left',on='person_id').drop_duplicates()
-        return self._enc_series(c,'CodeDescription','DM')
+    @memoize
+    def dm(self):
+        return self._enc_series(self.comorbidities(['dm']),'dm','DM')
     
     @property
+    @memoize
     def stroke(self):
-        c = self.db.diagnosis.sel(person_id=self.pid)
-        c = c.groupby('person_id').Code.apply(lambda s: s.isin(stroke).any()).rename('value')
-        c = self.encounter_info.merge(c.reset_index(),how='left',on='person_id').drop_duplicates().astype({'value':int})
-        return self._enc_series(c,'value','stroke')
+        return self._enc_series(self.comorbidities(['stroke']).astype({'stroke':int}),'stroke')
         
     def export(self, path, **kwargs):
         pass
\ No newline at end of file
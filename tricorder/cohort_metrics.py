@@ -1,9 +1,8 @@
-from tqdm.auto import tqdm
 import pandas as pd
 import seaborn as sns
 import numpy as np
 from scipy.interpolate import interp1d
-from .utils import tidy_labs, tidy_flow, tidy_meds, pivot_tidy, melt_tidy
+from .utils import tidy_labs, tidy_flow, tidy_meds, pivot_tidy, melt_tidy, replace_names, resample
 
 class Metric(object):
     REQUIRES = {}
@@ -17,10 +16,17 @@ class Metric(object):
         self.__db__ = db
         self.encounter_id = encounter_id
         self._checked_ids = False
+        self.plan = None
     
     def __attach__(self, obj):
         # Attach self to object passed in `obj`
         setattr(obj, '{}'.format(self.__class__.classname), self)
+
+    def _sel(self, table, **kwargs):
+        # Use the cohort's shared fetch plan when attached to one
+        if self.plan is not None:
+            return self.plan.sel(table, **kwargs)
+        return getattr(self.__db__, table).sel(**kwargs)
     
     def db_sample(self, n):
         """Fetch a random sample of required data from self.db
@@ -69,17 +75,17 @@ class Metric(object):
         
         for k,v in self.__class__.REQUIRES.items():
             if k == 'labs':
-                c  = self.__db__.labs.sel(lab_component_name=v, encounter_id=encounter_id)
+                c  = self._sel('labs', lab_component_name=v, encounter_id=encounter_id)
                 
                 c = self.after_labs_sel(c)
                 components.append(tidy_labs(c))
             elif k == 'flowsheet':
-                c  = self.__db__.flowsheet.sel(display_name=v, encounter_id=encounter_id)
+                c  = self._sel('flowsheet', display_name=v, encounter_id=encounter_id)
                 
                 c = self.after_flowsheet_sel(c)
                 components.append(tidy_flow(c))
             elif k == 'medications':
-                c = self.__db__.medications.sel(medication_name=v, encounter_id=encounter_id)
+                c = self._sel('medications', medication_name=v, encounter_id=encounter_id)
                 
                 c = self.after_medications_sel(c)
                 components.append(tidy_meds(c))
@@ -160,6 +166,73 @@ def compute_o2_content(hgb,sat,po2=None,x_new=None):
     c = (1.34 * s/100.0 * h) + (0.003 * p)
     return pd.DataFrame({'day':x_new,'value': c})
                 
+def segmented_interp(qid, qx, sid, sx, sy, missing=np.nan):
+    """Linearly interpolates many independent series (e.g. one per encounter) in one pass
+
+    Every series is shifted onto its own stretch of the x axis so a single np.interp
+    call covers all of them. Matches the interp1d setup of compute_o2_content: queries
+    before/after a series get its min/max value, single point series are constant.
+
+    Parameters
+    ----------
+    qid, qx : array-like
+        Series id and x value of the points to interpolate at
+    sid, sx, sy : array-like
+        Series id, x and y values of the known points
+    missing : float
+        Value returned for queries whose series has no known points
+    """
+    qid, qx = np.asarray(qid), np.asarray(qx, dtype=float)
+    out = np.full(len(qx), missing, dtype=float)
+    if len(sx) == 0 or len(qx) == 0:
+        return out
+
+    order = np.lexsort((np.asarray(sx), np.asarray(sid)))
+    sid = np.asarray(sid)[order]
+    sx = np.asarray(sx, dtype=float)[order]
+    sy = np.asarray(sy, dtype=float)[order]
+
+    ids, starts, counts = np.unique(sid, return_index=True, return_counts=True)
+    ends = starts + counts - 1
+    ymin = np.minimum.reduceat(sy, starts)
+    ymax = np.maximum.reduceat(sy, starts)
+
+    seg = np.clip(np.searchsorted(ids, qid), 0, len(ids)-1)
+    found = ids[seg] == qid
+
+    lo = sx.min()
+    width = sx.max() - lo + 1
+    key = np.repeat(np.arange(len(ids)), counts) * width + (sx - lo)
+    v = np.interp(seg * width + (qx - lo), key, sy)
+
+    v = np.where(qx < sx[starts][seg], ymin[seg], np.where(qx > sx[ends][seg], ymax[seg], v))
+    v = np.where(counts[seg] == 1, sy[starts][seg], v)
+    out[found] = v[found]
+    return out
+
+def o2_content_frame(hgb, sat, po2):
+    """Batched compute_o2_content for every encounter at once
+
+    Parameters
+    ----------
+    hgb, sat, po2 : pd.DataFrame
+        Tidy (encounter_id, time, value) frames of hemoglobin, O2 saturation and PO2
+
+    Returns
+    ----------
+    pd.DataFrame
+        encounter_id, day and O2 content value at every saturation measurement
+    """
+    days = lambda d: (d.time / np.timedelta64(1,'D')).values
+    qid, qx = sat.encounter_id.values, days(sat)
+
+    h = segmented_interp(qid, qx, hgb.encounter_id.values, days(hgb), hgb['value'].values, missing=np.nan)
+    p = segmented_interp(qid, qx, po2.encounter_id.values, days(po2), po2['value'].values, missing=0)
+
+    # Need to incorporate additional PO2 contribution
+    c = (1.34 * sat['value'].values/100.0 * h) + (0.003 * p)
+    return pd.DataFrame({'encounter_id':qid, 'day':qx, 'value':c})
+
 class OxygenContent(Metric):
     shortname = "O2_content"
     classname = 'OxygenContent'
@@ -185,39 +258,19 @@ class OxygenContent(Metric):
             components = self.db_fetch(encounter_id=sample)
         else:
             components = self.db_fetch()
-        grouper = components.groupby('encounter_id')
-        pbar = tqdm(grouper)
-        
-        dfs = []
-        
-        for _,df in pbar:
-            hgb = df[df['name'].isin(self.hgb_names)]
-            
-            enc_dfs = []
-            eid = df.encounter_id.values[0]
-            pbar.set_description('{}'.format(self.__class__.classname))
-            sata = df[df['name'].str.contains('O2SAT ARTERIAL')]
-            po2a = df[df['name'].str.contains('PO2 ARTERIAL')]
-            aC = compute_o2_content(hgb,sata,po2a)
-            aC['name'] = 'CaO2'
-            enc_dfs.append(aC)
-            
-            # pbar.set_description('{}_b'.format(eid))
-            satv = df[df['name'].str.contains('O2SAT VENOUS')]
-            po2v = df[df['name'].str.contains('PO2 VENOUS')]
-            vC = compute_o2_content(hgb,satv,po2v)
-            vC['name'] = 'CvO2'
-            enc_dfs.append(vC)
-
-            out = pd.concat(enc_dfs)
-            out['encounter_id']=eid
-            out['hour'] = (out.day*24).round().astype(int)
-            out['hour'] = pd.to_timedelta(out.hour-out.hour.min(), unit='hour')
-            dfs.append(out)
-            
-        return pd.concat(dfs)[['value','name','encounter_id','hour']].pivot_table(
-            index=['encounter_id','hour'],columns='name',values='value'
-        )
+        names = components['name']
+        hgb = components[names.isin(self.hgb_names)]
+
+        aC = o2_content_frame(hgb, components[names.str.contains('O2SAT ARTERIAL')], components[names.str.contains('PO2 ARTERIAL')])
+        aC['name'] = 'CaO2'
+        vC = o2_content_frame(hgb, components[names.str.contains('O2SAT VENOUS')], components[names.str.contains('PO2 VENOUS')])
+        vC['name'] = 'CvO2'
+
+        out = pd.concat([aC, vC])
+        out['hour'] = pd.to_timedelta(out.day, unit='D')
+
+        # Nearest hour since each encounter's first measurement
+        return resample(out, '1h', t='hour', how='round', origin='start').dropna(how='all')
     
 class OxygenDelivery(Metric):
     shortname = "DO2"
@@ -262,40 +315,23 @@ class OxygenDelivery(Metric):
         else:
             components = self.db_fetch()
         
-        components['name'] = components['name'].replace({'CARDIAC OUTPUT': 'CCO', 'O2 SAT ARTERIAL POC':'O2SAT ARTERIAL POC'})
-        grouper = components.groupby('encounter_id')
-        pbar = tqdm(grouper)
-        
-        dfs = []
-        
-        for _,df in pbar:
-            hgb = df[df['name'].isin(self.hgb_names)]
-            
-            enc_dfs = []
-            eid = df.encounter_id.values[0]
-            pbar.set_description('{}'.format(self.__class__.classname))
-            sata = df[df['name'].str.contains('O2SAT ARTERIAL')]
-            po2a = df[df['name'].str.contains('PO2 ARTERIAL')]
-            aC = compute_o2_content(hgb,sata,po2a)
-            aC['name'] = 'CaO2'
-            enc_dfs.append(aC)
-            
-            co = df[df['name'].isin(['CCO','CCI'])].reset_index(drop=True)
-            co['day'] = co.time / np.timedelta64(1,'D')
-            co = co.drop(columns='time')
-            enc_dfs.append(co)
-
-            out = pd.concat(enc_dfs)
-            if out.name.drop_duplicates().str.contains('CC').any() and 'CaO2' in out.name.unique():
-                out['encounter_id']=eid
-                # out['hour'] = (out.day*24).round().astype(int)
-                out['hour'] = (out.day*24).round(1)
-                dfs.append(out)
-            
-        output = pd.concat(dfs)[['value','name','encounter_id','hour']].pivot_table(
-            index=['encounter_id','hour'], columns='name', values='value'
-        )
-        return output
+        components['name'] = replace_names(components['name'], {'CARDIAC OUTPUT': 'CCO', 'O2 SAT ARTERIAL POC':'O2SAT ARTERIAL POC'})
+        names = components['name']
+        hgb = components[names.isin(self.hgb_names)]
+
+        aC = o2_content_frame(hgb, components[names.str.contains('O2SAT ARTERIAL')], components[names.str.contains('PO2 ARTERIAL')])
+        aC['name'] = 'CaO2'
+
+        co = components[names.isin(['CCO','CCI'])].reset_index(drop=True)
+        co['day'] = co.time / np.timedelta64(1,'D')
+        co = co.drop(columns='time')
+
+        out = pd.concat([aC, co])
+        out = out[out.encounter_id.isin(np.intersect1d(aC.encounter_id.unique(), co.encounter_id.unique()))]
+        out['time'] = pd.to_timedelta(out.day, unit='D')
+
+        # Nearest tenth of an hour
+        return resample(out, '6min', how='round').dropna(how='all')
     
     def compute(self, sample=None, encounter_id=None, with_components=False):
         df = self.get_components(sample=sample)
@@ -306,10 +342,7 @@ class OxygenDelivery(Metric):
         df['DO2_I'] = (10 * ci * ca).interpolate(limit_direction='forward')
         if not with_components:
             df = df[['DO2','DO2_I']]
-        df = melt_tidy(df, t='hour')
-        df = df.rename(columns={'hour':'time'})
-        df.time = pd.to_timedelta(df.time,unit='hour')
-        return df
+        return melt_tidy(df, t='time')
     
 class OxygenConsumption(Metric):
     shortname = "VO2"
@@ -343,47 +376,29 @@ class OxygenConsumption(Metric):
         else:
             components = self.db_fetch()
         
-        components['name'] = components['name'].replace({
+        components['name'] = replace_names(components['name'], {
             'CARDIAC OUTPUT': 'CCO',
             # 'O2SAT VENOUS MEASURED':'SVO2 (%)',
         })
-        grouper = components.groupby('encounter_id')
-        pbar = tqdm(grouper)
-        
-        dfs = []
-        
-        for _,df in pbar:
-            hgb = df[df['name'].isin(self.hgb_names)]
-            
-            enc_dfs = []
-            eid = df.encounter_id.values[0]
-            pbar.set_description('{}_a'.format(eid))
-            sata = df[df['name'].str.contains('O2SAT ARTERIAL')]
-            po2a = df[df['name'].str.contains('PO2 ARTERIAL')]
-            aC = compute_o2_content(hgb,sata,po2a)
-            aC['name'] = 'CaO2'
-            enc_dfs.append(aC)
-            
-            satv = df[df['name'].isin(['O2SAT VENOUS MEASURED','SVO2 (%)'])]
-            po2v = df[df['name'].str.contains('PO2 VENOUS')]
-            vC = compute_o2_content(hgb,satv,po2v)
-            vC['name'] = 'CvO2'
-            enc_dfs.append(vC)
-            
-            co = df[df['name'].isin(['CCO','CCI'])].reset_index(drop=True)
-            co['day'] = co.time / np.timedelta64(1,'D')
-            co = co.drop(columns='time')
-            enc_dfs.append(co)
-
-            out = pd.concat(enc_dfs)
-            if out.name.drop_duplicates().str.contains('CC').any() and 'CaO2' in out.name.unique() and 'CvO2' in out.name.unique():
-                out['encounter_id']=eid
-                out['hour'] = (out.day*24).round().astype(int)
-                dfs.append(out)
-            
-        output = pivot_tidy(pd.concat(dfs)[['value','name','encounter_id','hour']],t='hour')
-        
-        return output
+        names = components['name']
+        hgb = components[names.isin(self.hgb_names)]
+
+        aC = o2_content_frame(hgb, components[names.str.contains('O2SAT ARTERIAL')], components[names.str.contains('PO2 ARTERIAL')])
+        aC['name'] = 'CaO2'
+        vC = o2_content_frame(hgb, components[names.isin(['O2SAT VENOUS MEASURED','SVO2 (%)'])], components[names.str.contains('PO2 VENOUS')])
+        vC['name'] = 'CvO2'
+
+        co = components[names.isin(['CCO','CCI'])].reset_index(drop=True)
+        co['day'] = co.time / np.timedelta64(1,'D')
+        co = co.drop(columns='time')
+
+        out = pd.concat([aC, vC, co])
+        keeps = np.intersect1d(np.intersect1d(aC.encounter_id.unique(), vC.encounter_id.unique()), co.encounter_id.unique())
+        out = out[out.encounter_id.isin(keeps)]
+        out['time'] = pd.to_timedelta(out.day, unit='D')
+
+        # Nearest hour
+        return resample(out, '1h', how='round').dropna(how='all')
     
     def compute(self, sample=None, encounter_id=None, with_components=False):
         df = self._prep(sample=sample)
@@ -396,10 +411,10 @@ class OxygenConsumption(Metric):
         df['VO2_I'] = (10 * ci * cd).interpolate(limit_direction='forward')
         if not with_components:
             df = df[['VO2','VO2_I']]
-        df = melt_tidy(df, t='hour')
-        df = df.rename(columns={'hour':'time'})
-        df.time = pd.to_timedelta(df.time,unit='hour')
-        return df
+        return melt_tidy(df, t='time')
+
+def _drop_cvp_outliers(df, cvp_max):
+    return df[(df.name != 'CVP') | (df.value <= cvp_max)].reset_index(drop=True)
 
 class CardiacPower(Metric):
     shortname = "CPO"
@@ -424,29 +439,15 @@ class CardiacPower(Metric):
         else:
             components = self.db_fetch()
         
-        components['name'] = components['name'].replace({
+        components['name'] = replace_names(components['name'], {
             'CARDIAC OUTPUT': 'CCO',
             'A-LINE MAP '   : 'A-LINE MAP',
             'A-LINE 2 MAP ' : 'A-LINE MAP',
             'CVP (MMHG)'    : 'CVP',
         })
-        grouper = components.groupby('encounter_id')
-        pbar = tqdm(grouper)
-        
-        dfs = []
-        
-        for _,df in pbar:
-            enc_dfs = []
-            eid = df.encounter_id.values[0]
-            pbar.set_description('{}'.format(self.__class__.classname))
-            cvp_limits = self.__class__.limits['CVP']
-            cvp = df[df.name == 'CVP'].reset_index(drop=True)
-            cvp = cvp[cvp.value <= cvp_limits[-1]]
-            df = pd.concat([df[df.name != 'CVP'].reset_index(drop=True),cvp])
-            # if len(df.name.value_counts())==3:
-            dfs.append(df)
-    
-        output = pd.concat(dfs)[['value','name','encounter_id','time']]   
+        cvp_limits = self.__class__.limits['CVP']
+        output = _drop_cvp_outliers(components, cvp_limits[-1])
+        output = output[['value','name','encounter_id','time']]
         if pivot:
             return pivot_tidy(output, t='time')
         else:
@@ -0,0 +1,212 @@
+import os
+import json
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from . import codesets_ICD10, elixhauser, charlson
+
+# Comorbidity concepts. 'codes' are ICD-10 code prefixes, 'descriptions' exact
+# CodeDescription matches, 'contains' CodeDescription substrings and 'code_type'
+# restricts description matches to one CodeType
+CONCEPTS = {
+    'cad' : {'codes' : codesets_ICD10.cad},
+    'chf' : {'contains' : ['HEART FAILURE'], 'code_type' : 'ICD-10-CM'},
+    'dm' : {'contains' : ['DIABETES'], 'code_type' : 'ICD-10-CM'},
+    'osa' : {'descriptions' : ['UNSPECIFIED SLEEP APNEA', 'SLEEP APNEA, UNSPECIFIED'], 'code_type' : 'ICD-10-CM'},
+    'stroke' : {'codes' : codesets_ICD10.stroke},
+    'liver_disease' : {'codes' : elixhauser.liver_disease},
+    'renal_failure' : {'codes' : elixhauser.renal_failure},
+}
+
+# Comorbidity indices, modules holding categories, weights and hierarchy
+INDICES = {
+    'elixhauser' : elixhauser,
+    'charlson' : charlson,
+}
+
+# CodeType values of the diagnoses the ICD-10 code sets are matched against
+ICD10_CODE_TYPES = ['ICD-10', 'ICD-10-CM']
+
+def normalize_codes(codes):
+    """Upper case ICD-10 codes without the '.' so 'I25.10' and 'I2510' match, as an arrow array"""
+    try:
+        codes = pa.array(codes, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        codes = pa.array(pd.Index(codes, dtype=object).astype(str), type=pa.string())
+    return pc.utf8_upper(pc.replace_substring(codes, '.', ''))
+
+class PrefixMatcher(object):
+    """Compiled ICD-10 prefix matcher, maps codes to every concept with a prefix they fall under
+
+    Prefixes are grouped by length, so matching is one hash lookup of each code's head
+    per distinct prefix length (a handful for ICD-10) instead of one comparison per
+    prefix, and its cost doesn't depend on the size of the code sets.
+
+    Parameters
+    ----------
+    concepts : dict
+        Mapping of concept name to a list of code prefixes
+    """
+    def __init__(self, concepts):
+        self.concepts = list(concepts)
+        pairs = [(p,i) for i,c in enumerate(self.concepts) for p in normalize_codes(concepts[c]).to_pylist()]
+        self.levels = {}
+        for n in sorted({len(p) for p,_ in pairs}):
+            prefixes = {p:j for j,p in enumerate(sorted({p for p,_ in pairs if len(p) == n}))}
+            table = np.zeros((len(prefixes), len(self.concepts)), dtype=bool)
+            for p,i in pairs:
+                if len(p) == n:
+                    table[prefixes[p], i] = True
+            self.levels[n] = (pa.array(list(prefixes), type=pa.string()), table)
+
+    def match(self, codes):
+        """Boolean (codes x concepts) array of prefix matches
+
+        Parameters
+        ----------
+        codes : array-like
+            ICD-10 codes, with or without the '.'
+        """
+        codes = normalize_codes(codes)
+        out = np.zeros((len(codes), len(self.concepts)), dtype=bool)
+        for n,(prefixes,table) in self.levels.items():
+            heads = pc.utf8_slice_codeunits(codes, 0, n)
+            j = pc.fill_null(pc.index_in(heads, value_set=prefixes), -1).to_numpy()
+            hit = j >= 0
+            out[hit] |= table[j[hit]]
+        return out
+
+@functools.lru_cache(maxsize=None)
+def compile_matcher(concepts):
+    """PrefixMatcher for a tuple of CONCEPTS keys, compiled once per tuple"""
+    return PrefixMatcher({c: CONCEPTS[c].get('codes', []) for c in concepts})
+
+def _lookup(values, match):
+    # Matches the categories once and broadcasts them to the rows, missing values don't match
+    values = pd.Series(values).astype('category').cat
+    table = match(values.categories)
+    return np.vstack([table, np.zeros((1, table.shape[1]), dtype=bool)])[values.codes]
+
+def _per_concept(concepts, match):
+    return lambda values: np.column_stack([match(values, CONCEPTS[c]) for c in concepts])
+
+def _match_descriptions(descriptions, spec):
+    descriptions = pd.Index(descriptions, dtype=object).astype(str)
+    mask = descriptions.isin(spec.get('descriptions', []))
+    for s in spec.get('contains', []):
+        mask |= descriptions.str.contains(s, regex=False)
+    return mask
+
+def _match_code_type(code_types, spec):
+    return pd.Index(code_types, dtype=object).isin([spec['code_type']]) if 'code_type' in spec else np.ones(len(code_types), dtype=bool)
+
+def flag_comorbidities(dx, concepts=None, by='person_id'):
+    """Flags which comorbidity concepts each patient has been diagnosed with
+
+    Matches are looked up once per distinct Code, CodeDescription and CodeType and
+    broadcast to the rows, codes through the compiled PrefixMatcher. Codes are only
+    matched on ICD-10 rows (ICD10_CODE_TYPES).
+
+    Parameters
+    ----------
+    dx : pd.DataFrame
+        Diagnosis rows with Code, CodeDescription and CodeType columns
+    concepts : list of str, optional
+        Keys of CONCEPTS, defaults to all of them
+    by : str
+        Column to aggregate flags over
+
+    Returns
+    -------
+    pd.DataFrame
+        Boolean frame indexed by `by` with one column per concept
+    """
+    concepts = list(CONCEPTS) if concepts is None else list(concepts)
+    for c in concepts:
+        assert c in CONCEPTS, 'unknown comorbidity "{}", options are {}'.format(c, list(CONCEPTS))
+
+    # Codes are only matched on ICD-10 rows, ICD-9 E codes collide with ICD-10 prefixes
+    icd10 = _lookup(dx.CodeType, lambda t: pd.Index(t, dtype=object).isin(ICD10_CODE_TYPES)[:,None])[:,0]
+    rows = _lookup(dx.Code, compile_matcher(tuple(concepts)).match) & icd10[:,None]
+    described = _lookup(dx.CodeDescription, _per_concept(concepts, _match_descriptions))
+    rows |= described & _lookup(dx.CodeType, _per_concept(concepts, _match_code_type))
+
+    groups, keys = pd.factorize(dx[by], sort=True)
+    valid = groups >= 0
+    flags = {c: np.bincount(groups[valid], weights=rows[valid,i], minlength=len(keys)) > 0 for i,c in enumerate(concepts)}
+    return pd.DataFrame(flags, index=pd.Index(keys, name=by))
+
+def _weighted_score(flags, index):
+    counted = flags[list(index.weights)].copy()
+    for category, superseded_by in index.hierarchy:
+        counted[category] &= ~counted[superseded_by]
+    return counted.to_numpy(dtype=int) @ np.array(list(index.weights.values()))
+
+def code_set_version(index):
+    """Hash of an index's categories, weights and hierarchy, changes whenever its code sets are edited"""
+    definition = json.dumps([index.categories, index.weights, index.hierarchy], sort_keys=True)
+    return hashlib.sha1(definition.encode()).hexdigest().encode()
+
+def score_comorbidities(table, index='elixhauser', cache=True, batch_size=1000000):
+    """Elixhauser or Charlson categories and weighted score for every person in a diagnosis table
+
+    ICD-10 codes (ICD10_CODE_TYPES) are streamed through a compiled PrefixMatcher one batch
+    at a time and only the per person flags are kept, so memory is bounded by batch_size and
+    the number of people. The result is persisted beside the table and reused until the
+    table's mtime or the index's code sets change.
+
+    Parameters
+    ----------
+    table : tricorder.tables.Table
+        Diagnosis table, e.g. SWAN.diagnosis
+    index : str
+        'elixhauser' (van Walraven weights) or 'charlson'
+    cache : bool
+        Read and write the persisted result
+    batch_size : int
+        Maximum number of diagnosis rows decoded at a time
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by person_id with a boolean column per category and the weighted score
+    """
+    assert index in INDICES, 'unknown index "{}", options are {}'.format(index, list(INDICES))
+    fp = table._cache_path('.{}.parquet'.format(index))
+    version = {
+        b'source_mtime' : str(os.path.getmtime(table.file_path)).encode(),
+        b'code_sets' : code_set_version(INDICES[index]),
+    }
+    if cache and os.path.exists(fp):
+        tab = pq.read_table(fp)
+        metadata = tab.schema.metadata or {}
+        if all(metadata.get(k) == v for k,v in version.items()):
+            return tab.to_pandas()
+
+    matcher = PrefixMatcher(INDICES[index].categories)
+    flags = []
+    for batch in table.iter_sel(CodeType=ICD10_CODE_TYPES, columns=['person_id','Code'], batch_size=batch_size):
+        batch = batch.filter(pc.is_valid(batch['person_id']))
+        codes = batch['Code'].combine_chunks()
+        if not pa.types.is_dictionary(codes.type):
+            codes = pc.dictionary_encode(codes)
+        # Match each distinct code once, missing codes take the trailing all False row
+        hits = np.vstack([matcher.match(codes.dictionary), np.zeros((1, len(matcher.concepts)), dtype=bool)])
+        hits = hits[pc.fill_null(codes.indices, -1).to_numpy()]
+        flags.append(pd.DataFrame(hits, columns=matcher.concepts).groupby(batch['person_id'].to_numpy()).any())
+
+    flags = pd.concat(flags).groupby(level=0).any() if flags else pd.DataFrame(columns=matcher.concepts, dtype=bool)
+    flags.index.name = 'person_id'
+    flags['score'] = _weighted_score(flags, INDICES[index])
+
+    if cache:
+        tab = pa.Table.from_pandas(flags)
+        try:
+            pq.write_table(tab.replace_schema_metadata({**tab.schema.metadata, **version}), fp)
+        except (IOError, OSError):
+            print('unable to write {} scores for {}'.format(index, table.table_fn))
+    return flags
@@ -1,18 +1,256 @@
+"""Elixhauser comorbidity categories, ICD-10 coding algorithm of Quan et al. (Med Care 2005)
+
+Entries are code prefixes, e.g. 'K70' covers every K70.x code.
+"""
+from .codesets_ICD10 import code_range
+
+congestive_heart_failure = [
+    'I09.9','I11.0','I13.0','I13.2','I25.5','I42.0',
+    *code_range('I42.5','I42.9'),
+    'I43','I50','P29.0',
+]
+
+cardiac_arrhythmias = [
+    *code_range('I44.1','I44.3'),
+    'I45.6','I45.9',
+    *code_range('I47','I49'),
+    'R00.0','R00.1','R00.8','T82.1','Z45.0','Z95.0',
+]
+
+valvular_disease = [
+    'A52.0',
+    *code_range('I05','I08'),
+    'I09.1','I09.8',
+    *code_range('I34','I39'),
+    *code_range('Q23.0','Q23.3'),
+    *code_range('Z95.2','Z95.4'),
+]
+
+pulmonary_circulation_disorders = [
+    'I26','I27','I28.0','I28.8','I28.9',
+]
+
+peripheral_vascular_disorders = [
+    'I70','I71','I73.1','I73.8','I73.9','I77.1','I79.0','I79.2',
+    'K55.1','K55.8','K55.9','Z95.8','Z95.9',
+]
+
+hypertension_uncomplicated = [
+    'I10',
+]
+
+hypertension_complicated = [
+    *code_range('I11','I13'),
+    'I15',
+]
+
+paralysis = [
+    'G04.1','G11.4','G80.1','G80.2','G81','G82',
+    *code_range('G83.0','G83.4'),
+    'G83.9',
+]
+
+other_neurological_disorders = [
+    *code_range('G10','G13'),
+    *code_range('G20','G22'),
+    'G25.4','G25.5','G31.2','G31.8','G31.9','G32',
+    *code_range('G35','G37'),
+    'G40','G41','G93.1','G93.4','R47.0','R56',
+]
+
+chronic_pulmonary_disease = [
+    'I27.8','I27.9',
+    *code_range('J40','J47'),
+    *code_range('J60','J67'),
+    'J68.4','J70.1','J70.3',
+]
+
+diabetes_uncomplicated = [
+    code for e in code_range('E10','E14') for code in [e+'.0', e+'.1', e+'.9']
+]
+
+diabetes_complicated = [
+    code for e in code_range('E10','E14') for code in code_range(e+'.2', e+'.8')
+]
+
+hypothyroidism = [
+    *code_range('E00','E03'),
+    'E89.0',
+]
+
+renal_failure = [
+    'I12.0','I13.1','N18','N19','N25.0',
+    *code_range('Z49.0','Z49.2'),
+    'Z94.0','Z99.2',
+]
+
 liver_disease = [
+    'B18','I85','I86.4','I98.2','K70','K71.1',
+    *code_range('K71.3','K71.5'),
+    'K71.7',
+    *code_range('K72','K74'),
+    'K76.0',
+    *code_range('K76.2','K76.9'),
     'Z94.4',
-    'K70'
-    'K72','K73','K74',
-    'B18',
-    'I98.2',
-    'K76.02','K76.03',
-    'K71.1'
 ]
 
-renal_failure = [
-    'Z99.2',
-    'Z94.0',
-    'N25.9',
-    'Z49.0','Z49.1','Z49.2',
-    'I13.1','I12.0','
+peptic_ulcer_disease = [
+    'K25.7','K25.9','K26.7','K26.9','K27.7','K27.9','K28.7','K28.9',
 ]
 
+aids_hiv = [
+    *code_range('B20','B22'),
+    'B24',
+]
+
+lymphoma = [
+    *code_range('C81','C85'),
+    'C88','C96','C90.0','C90.2',
+]
+
+metastatic_cancer = [
+    *code_range('C77','C80'),
+]
+
+solid_tumor = [
+    *code_range('C00','C26'),
+    *code_range('C30','C34'),
+    *code_range('C37','C41'),
+    'C43',
+    *code_range('C45','C58'),
+    *code_range('C60','C76'),
+    'C97',
+]
+
+rheumatoid_arthritis = [
+    'L94.0','L94.1','L94.3','M05','M06','M08','M12.0','M12.3','M30',
+    *code_range('M31.0','M31.3'),
+    *code_range('M32','M35'),
+    'M45','M46.1','M46.8','M46.9',
+]
+
+coagulopathy = [
+    *code_range('D65','D68'),
+    'D69.1',
+    *code_range('D69.3','D69.6'),
+]
+
+obesity = [
+    'E66',
+]
+
+weight_loss = [
+    *code_range('E40','E46'),
+    'R63.4','R64',
+]
+
+fluid_electrolyte_disorders = [
+    'E22.2','E86','E87',
+]
+
+blood_loss_anemia = [
+    'D50.0',
+]
+
+deficiency_anemia = [
+    'D50.8','D50.9',
+    *code_range('D51','D53'),
+]
+
+alcohol_abuse = [
+    'F10','E52','G62.1','I42.6','K29.2','K70.0','K70.3','K70.9','T51',
+    'Z50.2','Z71.4','Z72.1',
+]
+
+drug_abuse = [
+    *code_range('F11','F16'),
+    'F18','F19','Z71.5','Z72.2',
+]
+
+psychoses = [
+    'F20',
+    *code_range('F22','F25'),
+    'F28','F29','F30.2','F31.2','F31.5',
+]
+
+depression = [
+    'F20.4',
+    *code_range('F31.3','F31.5'),
+    'F32','F33','F34.1','F41.2','F43.2',
+]
+
+categories = {
+    'congestive_heart_failure' : congestive_heart_failure,
+    'cardiac_arrhythmias' : cardiac_arrhythmias,
+    'valvular_disease' : valvular_disease,
+    'pulmonary_circulation_disorders' : pulmonary_circulation_disorders,
+    'peripheral_vascular_disorders' : peripheral_vascular_disorders,
+    'hypertension_uncomplicated' : hypertension_uncomplicated,
+    'hypertension_complicated' : hypertension_complicated,
+    'paralysis' : paralysis,
+    'other_neurological_disorders' : other_neurological_disorders,
+    'chronic_pulmonary_disease' : chronic_pulmonary_disease,
+    'diabetes_uncomplicated' : diabetes_uncomplicated,
+    'diabetes_complicated' : diabetes_complicated,
+    'hypothyroidism' : hypothyroidism,
+    'renal_failure' : renal_failure,
+    'liver_disease' : liver_disease,
+    'peptic_ulcer_disease' : peptic_ulcer_disease,
+    'aids_hiv' : aids_hiv,
+    'lymphoma' : lymphoma,
+    'metastatic_cancer' : metastatic_cancer,
+    'solid_tumor' : solid_tumor,
+    'rheumatoid_arthritis' : rheumatoid_arthritis,
+    'coagulopathy' : coagulopathy,
+    'obesity' : obesity,
+    'weight_loss' : weight_loss,
+    'fluid_electrolyte_disorders' : fluid_electrolyte_disorders,
+    'blood_loss_anemia' : blood_loss_anemia,
+    'deficiency_anemia' : deficiency_anemia,
+    'alcohol_abuse' : alcohol_abuse,
+    'drug_abuse' : drug_abuse,
+    'psychoses' : psychoses,
+    'depression' : depression,
+}
+
+# van Walraven et al. (Med Care 2009) weights
+weights = {
+    'congestive_heart_failure' : 7,
+    'cardiac_arrhythmias' : 5,
+    'valvular_disease' : -1,
+    'pulmonary_circulation_disorders' : 4,
+    'peripheral_vascular_disorders' : 2,
+    'hypertension_uncomplicated' : 0,
+    'hypertension_complicated' : 0,
+    'paralysis' : 7,
+    'other_neurological_disorders' : 6,
+    'chronic_pulmonary_disease' : 3,
+    'diabetes_uncomplicated' : 0,
+    'diabetes_complicated' : 0,
+    'hypothyroidism' : 0,
+    'renal_failure' : 5,
+    'liver_disease' : 11,
+    'peptic_ulcer_disease' : 0,
+    'aids_hiv' : 0,
+    'lymphoma' : 9,
+    'metastatic_cancer' : 12,
+    'solid_tumor' : 4,
+    'rheumatoid_arthritis' : 0,
+    'coagulopathy' : 3,
+    'obesity' : -4,
+    'weight_loss' : 6,
+    'fluid_electrolyte_disorders' : 5,
+    'blood_loss_anemia' : -2,
+    'deficiency_anemia' : -2,
+    'alcohol_abuse' : 0,
+    'drug_abuse' : -7,
+    'psychoses' : 0,
+    'depression' : -3,
+}
+
+# (category, superseded by) pairs, only the more severe category counts towards the score
+hierarchy = [
+    ('hypertension_uncomplicated', 'hypertension_complicated'),
+    ('diabetes_uncomplicated', 'diabetes_complicated'),
+    ('solid_tumor', 'metastatic_cancer'),
+]
@@ -27,4 +27,53 @@ def mpog_aki(df, result_col='lab_result_value'):
     elif cr7dmax >= 1.5*cr_basl or cr2dmax > cr_basl+0.3:
         return 1
     else:
-        return 0
\ No newline at end of file
+        return 0
+
+def mpog_aki_frame(df, result_col='lab_result_value', time_col='time'):
+    """Vectorized mpog_aki, stages every encounter in df in one pass
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Creatinine values with encounter_id, time (relative to surgery) and result_col columns
+    result_col : str
+        Column of creatinine values
+    time_col : str
+        Column of times relative to surgery as timedeltas or days
+
+    Returns
+    ----------
+    pd.DataFrame
+        encounter_id and the AKI code (see aki_code_map) of every encounter as value
+    """
+    days = df[time_col]
+    if pd.api.types.is_timedelta64_dtype(days):
+        days = days / np.timedelta64(1,'D')
+    cr = df[result_col]
+
+    windows = pd.DataFrame({
+        'encounter_id' : df.encounter_id.values,
+        'preop' : (days <= 0).values,
+        'postop' : (days >= 1).values,
+        'cr_basl' : cr.where(days <= 0).values,
+        'cr7dmax' : cr.where((days > 0) & (days <= 7)).values,
+        'cr2dmax' : cr.where((days > 0) & (days <= 2)).values,
+    })
+    e = windows.groupby('encounter_id').agg(
+        preop=('preop','any'),
+        postop=('postop','any'),
+        cr_basl=('cr_basl','mean'),
+        cr7dmax=('cr7dmax','max'),
+        cr2dmax=('cr2dmax','max'),
+    )
+
+    # Conditions are checked in the same order as mpog_aki, comparisons against NaN are False
+    conditions = [
+        ~e.preop,
+        ~e.postop,
+        (e.cr7dmax >= 3*e.cr_basl) | (e.cr7dmax > 4),
+        e.cr7dmax >= 2*e.cr_basl,
+        (e.cr7dmax >= 1.5*e.cr_basl) | (e.cr2dmax > e.cr_basl+0.3),
+    ]
+    codes = np.select(conditions, [-3,-1,3,2,1], default=0)
+    return pd.DataFrame({'encounter_id':e.index.values, 'value':codes})
@@ -1,5 +1,7 @@
 import numpy as np
 import pandas as pd
+from .utils import tidy_labs, tidy_flow, tidy_meds
+from .outcome_utils import mpog_aki_frame
 
 class Outcome(object):
     REQUIRES = {}
@@ -131,7 +133,15 @@ class PostOpAKI(Outcome):
         0 :'No AKI',
     }
     
-    def compute(self):
+    def compute(self, events, sample=None):
+        """Stage postop AKI for every encounter
+        Parameters
+        ----------
+        events : pd.DataFrame
+            encounter_id and offset (procedure day) columns to align creatinine times to
+        sample : int or list, optional
+            Number of encounters to sample or list of encounter ids
+        """
         if sample is not None and isinstance(sample, int):    
             components = self.db_sample(n=sample).dropna().sort_values(['encounter_id','time'])
         elif sample is not None and isinstance(sample, (list, type(np.array([])), type(pd.Series()))):
@@ -139,13 +149,12 @@ class PostOpAKI(Outcome):
         else:
             components = self.db_fetch()
         components = components.query('value <= 25 and value >= 0.2').reset_index()
-        grouper = components.groupby('encounter_id')
-        pbar = tqdm(grouper)
-        
-        dfs = []
-        
-        for _,df in pbar:
-            code = mpog_aki(df,result_col='value')
+        components = components.merge(events[['encounter_id','offset']], on='encounter_id', how='left')
+        components.time = components.time - pd.to_timedelta(components.offset,unit='day')
+
+        aki = mpog_aki_frame(components,result_col='value')
+        aki['desc'] = aki.value.map(self.__class__.CODE_DESCRIPTION)
+        return aki
 
 def mpog_aki(df, result_col='lab_result_value'):
     df.time = df.time / np.timedelta64(1,'D')
@@ -5,7 +5,7 @@ import pandas as pd
 import pyarrow
 import pyarrow.parquet as pq
 import tarfile
-from .tables import Table
+from .tables import Table, TableCache
 from .cohort import ProcedureCohort
 
 NEW_COLUMNS = {
@@ -39,20 +39,21 @@ class SWAN():
     def __init__(self, root_dir = '/data/compass/SWAN'):
         self.root = root_dir
         self.raw_dir = os.path.join(self.root,'raw')
+        self.table_cache = TableCache()
         
-        self.encounters = Table(os.path.join(self.raw_dir,'Table1_Encounter_Info.csv'))
+        self.encounters = Table(os.path.join(self.raw_dir,'Table1_Encounter_Info.csv'), table_cache=self.table_cache)
 
-        self.flowsheet = Table(os.path.join(self.raw_dir, 'Table2_Flowsheet.csv'))
+        self.flowsheet = Table(os.path.join(self.raw_dir, 'Table2_Flowsheet.csv'), table_cache=self.table_cache)
         
-        self.labs = Table(os.path.join(self.raw_dir, 'Table3_Lab.csv'))
+        self.labs = Table(os.path.join(self.raw_dir, 'Table3_Lab.csv'), table_cache=self.table_cache)
         
-        self.procedures = Table(os.path.join(self.raw_dir,'Table6_Procedures.csv'))
+        self.procedures = Table(os.path.join(self.raw_dir,'Table6_Procedures.csv'), table_cache=self.table_cache)
 
-        self.diagnosis = Table(os.path.join(self.raw_dir,'Table7_DX.csv'))
+        self.diagnosis = Table(os.path.join(self.raw_dir,'Table7_DX.csv'), table_cache=self.table_cache)
 
-        self.transfusion = Table(os.path.join(self.raw_dir,'Table5_Blood_Transfusion.csv'))
+        self.transfusion = Table(os.path.join(self.raw_dir,'Table5_Blood_Transfusion.csv'), table_cache=self.table_cache)
 
-        self.medications = Table(os.path.join(self.raw_dir,'Table4_Administered_Medication.csv'))
+        self.medications = Table(os.path.join(self.raw_dir,'Table4_Administered_Medication.csv'), table_cache=self.table_cache)
         
         self.tables = ['encounters','flowsheet','labs','procedures','diagnosis','transfusion','medications']
 
@@ -116,17 +117,18 @@ class SWANDemo(SWAN):
     def __init__(self, root_dir = '/datasets/swandemo'):
         self.root = root_dir
         self.raw_dir = root_dir
+        self.table_cache = TableCache()
         
-        self.encounters = Table(os.path.join(self.raw_dir,'Table1_Encounter_Info.csv'))
+        self.encounters = Table(os.path.join(self.raw_dir,'Table1_Encounter_Info.csv'), table_cache=self.table_cache)
 
-        self.flowsheet = Table(os.path.join(self.raw_dir, 'Table2_Flowsheet.csv'))
+        self.flowsheet = Table(os.path.join(self.raw_dir, 'Table2_Flowsheet.csv'), table_cache=self.table_cache)
         
-        self.labs = Table(os.path.join(self.raw_dir, 'Table3_Lab.csv'))
+        self.labs = Table(os.path.join(self.raw_dir, 'Table3_Lab.csv'), table_cache=self.table_cache)
         
-        self.procedures = Table(os.path.join(self.raw_dir,'Table6_Procedures.csv'))
+        self.procedures = Table(os.path.join(self.raw_dir,'Table6_Procedures.csv'), table_cache=self.table_cache)
 
-        self.diagnosis = Table(os.path.join(self.raw_dir,'Table7_DX.csv'))
+        self.diagnosis = Table(os.path.join(self.raw_dir,'Table7_DX.csv'), table_cache=self.table_cache)
 
-        self.transfusion = Table(os.path.join(self.raw_dir,'Table5_Blood_Transfusion.csv'))
+        self.transfusion = Table(os.path.join(self.raw_dir,'Table5_Blood_Transfusion.csv'), table_cache=self.table_cache)
 
-        self.medications = Table(os.path.join(self.raw_dir,'Table4_Administered_Medication.csv'))
\ No newline at end of file
+        self.medications = Table(os.path.join(self.raw_dir,'Table4_Administered_Medication.csv'), table_cache=self.table_cache)
\ No newline at end of file
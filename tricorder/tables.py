@@ -1,10 +1,13 @@
 import os
+import json
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
 import pyarrow.compute as pc
 import pyarrow.csv as csv
+import pyarrow.dataset as ds
 from slugify import slugify
 from .utils import search, load_table
 
@@ -30,56 +33,188 @@ SANITIZE_COLS = {
     'Table7_DX.csv' : ['CodeDescription'],
 }
 
+TIME_COLS = {
+    'Table1_Encounter_Info.csv': [],
+    'Table2_Flowsheet.csv' : ['flowsheet_days_since_birth','flowsheet_time'],
+    'Table3_Lab.csv' : ['lab_collection_days_since_birth','lab_collection_time'],
+    'Table4_Administered_Medication.csv' : ['administered_days_since_birth','administered_time'],
+    'Table5_Blood_Transfusion.csv' : ['days_from_dob_procstart'],
+    'Table6_Procedures.csv' : ['days_from_dob_procstart'],
+    'Table7_DX.csv' : [],
+}
+
+NAME = pa.dictionary(pa.int32(), pa.string())
+
+# Declared arrow types of the decoded tables, columns not listed are inferred. Numeric and
+# boolean columns are read as strings and cast leniently (see lenient_cast), times of day
+# are kept as HH:MM:SS strings
+SCHEMAS = {
+    'Table1_Encounter_Info.csv': pa.schema([
+        ('encounter_id', pa.uint64()),
+        ('person_id', pa.uint64()),
+        ('age', pa.int32()),
+        ('financial_class', NAME),
+        ('death_during_encounter', pa.bool_()),
+    ]),
+    'Table2_Flowsheet.csv' : pa.schema([
+        ('encounter_id', pa.uint64()),
+        ('flowsheet_days_since_birth', pa.int32()),
+        ('flowsheet_time', pa.string()),
+        ('display_name', NAME),
+        ('flowsheet_value', pa.string()),
+    ]),
+    'Table3_Lab.csv' : pa.schema([
+        ('encounter_id', pa.uint64()),
+        ('lab_collection_days_since_birth', pa.int32()),
+        ('lab_collection_time', pa.string()),
+        ('lab_component_name', NAME),
+        ('lab_result_value', pa.string()),
+        ('lab_result_unit', NAME),
+    ]),
+    'Table4_Administered_Medication.csv' : pa.schema([
+        ('encounter_id', pa.uint64()),
+        ('administered_days_since_birth', pa.int32()),
+        ('administered_time', pa.string()),
+        ('medication_name', NAME),
+    ]),
+    'Table5_Blood_Transfusion.csv' : pa.schema([
+        ('encounter_id', pa.uint64()),
+        ('person_id', pa.uint64()),
+        ('transfusion_name', NAME),
+        ('days_from_dob_procstart', pa.int32()),
+    ]),
+    'Table6_Procedures.csv' : pa.schema([
+        ('encounter_id', pa.uint64()),
+        ('person_id', pa.uint64()),
+        ('order_name', NAME),
+        ('days_from_dob_procstart', pa.int32()),
+    ]),
+    'Table7_DX.csv' : pa.schema([
+        ('person_id', pa.uint64()),
+        ('Code', NAME),
+        ('CodeDescription', NAME),
+        ('CodeType', NAME),
+        ('Provenance', NAME),
+    ]),
+}
+
+# Columns that can hold censored values (e.g. '>89'), read as strings then split
+# into their bound and a boolean <column>_censored flag
+CENSORED_COLS = {
+    'Table1_Encounter_Info.csv': ['age'],
+    'Table2_Flowsheet.csv' : ['flowsheet_days_since_birth'],
+    'Table3_Lab.csv' : ['lab_collection_days_since_birth'],
+    'Table4_Administered_Medication.csv' : ['administered_days_since_birth'],
+    'Table5_Blood_Transfusion.csv' : ['days_from_dob_procstart'],
+    'Table6_Procedures.csv' : ['days_from_dob_procstart'],
+    'Table7_DX.csv' : [],
+}
+
+# pandas dtypes of the raw tables, derived from SCHEMAS (names and strings as str)
 RAW_DTYPES = {
-    'Table1_Encounter_Info.csv': {
-        'encounter_id': np.uint,
-        'person_id': np.uint,
-#         'gender': str,
-        'age': np.uint8,
-        'financial_class': str,
-        'death_during_encounter': bool
-    
-    },'Table2_Flowsheet.csv' : {
-        'encounter_id':np.uint,
-        'flowsheet_days_since_birth': np.uint,
-#         'flowsheet_time':str,
-        'display_name':str,
-        
-    }, 'Table3_Lab.csv' : {
-        'encounter_id':np.uint,
-        'lab_component_name': str,
-        'lab_result_value' : str,
-#         'lab_result_unit' : str,
-        'lab_collection_days_since_birth': np.uint
-
-    }, 'Table4_Administered_Medication.csv' : {
-        'encounter_id':np.uint,
-        'administered_days_since_birth': int,
-        'administered_time': str,
-        'medication_name' : str,
-        #'dose': np.uint,
-
-    }, 'Table5_Blood_Transfusion.csv' : {
-        'encounter_id':np.uint,
-        'transfusion_name':str,
-#         'days_from_dob_procstart':np.uint,
-
-    }, 'Table6_Procedures.csv' : {
-        'encounter_id':np.uint,
-        'order_name':str,
-#         'days_from_dob_procstart':np.uint,
-
-    }, 'Table7_DX.csv': {
-        'person_id': np.uint,
-#         'gender': str,
-        'CodeDescription':str,
-        'Provenance':str,
-    },
+    fn : {f.name: str if pa.types.is_string(f.type) or pa.types.is_dictionary(f.type) else f.type.to_pandas_dtype() for f in schema}
+    for fn,schema in SCHEMAS.items()
 }
 
+def lenient_cast(col, typ):
+    """Casts a string column to typ, values that don't parse become null instead of failing
+
+    Parameters
+    ----------
+    col : pyarrow.Array or pyarrow.ChunkedArray
+             String values read from a raw csv
+    typ : pyarrow.DataType
+             Integer or boolean type to cast to
+    """
+    col = pc.if_else(pc.equal(col, ''), pa.scalar(None, pa.string()), col)
+    try:
+        return pc.cast(col, typ)
+    except pa.ArrowInvalid:
+        pass
+
+    col = pc.utf8_trim_whitespace(col)
+    if pa.types.is_integer(typ):
+        valid = pc.match_substring_regex(col, r'^\d+$' if pa.types.is_unsigned_integer(typ) else r'^[-+]?\d+$')
+    else:
+        col = pc.utf8_lower(col)
+        valid = pc.is_in(col, value_set=pa.array(['true','false','1','0']))
+    valid = pc.fill_null(valid, False)
+    n_invalid = len(col) - col.null_count - pc.sum(valid).as_py()
+    print('{} malformed {} values read as missing'.format(n_invalid, typ))
+    return pc.cast(pc.if_else(valid, col, pa.scalar(None, pa.string())), typ)
+
+class TableCache(object):
+    """Memory bounded LRU cache of decoded arrow tables keyed on (file path, mtime)
+
+    A single TableCache is meant to be shared by all the Table objects of a database
+    (e.g. SWAN or TAVR) so repeated sel calls against the same file only decode it once.
+
+    Parameters
+    ----------
+    max_bytes : int
+             Total size in bytes of the tables kept in memory, least recently used
+             tables are evicted once this is exceeded. Files whose decoded table turns
+             out larger than this are remembered and scanned with pushdown from then on
+    """
+    def __init__(self, max_bytes=2*1024**3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        self._rejected = {}
+
+    def __repr__(self):
+        return 'TableCache(tables={}, nbytes={}, max_bytes={})'.format(len(self._tables), self.nbytes, self.max_bytes)
+
+    def _key(self, fp):
+        return (fp, os.path.getmtime(fp))
+
+    def admits(self, nbytes, fp=None):
+        if fp is not None and self._key(fp) in self._rejected:
+            return False
+        return nbytes <= self.max_bytes
+
+    def reject(self, fp, nbytes):
+        """Records that fp decodes to at least nbytes, too large to be cached"""
+        self._rejected[self._key(fp)] = nbytes
+
+    def get(self, fp):
+        key = self._key(fp)
+        if key in self._tables:
+            self.hits += 1
+            self._tables.move_to_end(key)
+            return self._tables[key]
+        self.misses += 1
+        return None
+
+    def put(self, fp, tab):
+        # Drop entries from older versions of the same file
+        for k in [k for k in self._tables.keys() if k[0] == fp]:
+            self._evict(k)
+
+        if not self.admits(tab.nbytes):
+            self.reject(fp, tab.nbytes)
+            return
+        self._tables[self._key(fp)] = tab
+        self.nbytes += tab.nbytes
+        while self.nbytes > self.max_bytes:
+            self._evict(next(iter(self._tables)))
+
+    def _evict(self, key):
+        self.nbytes -= self._tables.pop(key).nbytes
+
+    def clear(self):
+        self._tables.clear()
+        self._rejected.clear()
+        self.nbytes = 0
+
+TABLE_CACHE = TableCache()
+
 class Table(object):
-    def __init__(self, raw_fp):
+    def __init__(self, raw_fp, table_cache=None):
         self.file_path = raw_fp
+        self.table_cache = table_cache if table_cache is not None else TABLE_CACHE
 
         # Extract the file directory and the file name
         self.data_root, self.table_fn = os.path.split(self.file_path)
@@ -90,29 +225,94 @@ class Table(object):
             self.default_col = None
         
         self.df = None
-        self.default_unique = None
+        self._csv_schema = None
+        self._values_index = {}
+
+    def _column_types(self):
+        """Arrow types the raw csv is read with, censored, numeric and boolean columns are read as strings"""
+        censored = CENSORED_COLS.get(self.table_fn, [])
+        return {f.name: f.type if pa.types.is_dictionary(f.type) and f.name not in censored else pa.string() for f in SCHEMAS.get(self.table_fn, [])}
+
+    def _read_csv(self):
+        return csv.read_csv(self.file_path, convert_options=csv.ConvertOptions(column_types=self._column_types()))
+
+    @property
+    def raw_schema(self):
+        """pyarrow.Schema the raw csv is read with
+
+        Inferred from the header and first block of the file only, cached until the file changes
+        """
+        mtime = os.path.getmtime(self.file_path)
+        if self._csv_schema is None or self._csv_schema[0] != mtime:
+            reader = csv.open_csv(self.file_path, convert_options=csv.ConvertOptions(column_types=self._column_types()))
+            self._csv_schema = (mtime, reader.schema)
+            reader.close()
+        return self._csv_schema[1]
+
+    @property
+    def schema(self):
+        """pyarrow.Schema of the tables returned by scan and sel, the schema of a decoded empty table"""
+        return self._decode(self.raw_schema.empty_table()).schema
 
     def sanitize_table(self, tab, column=None):
         column = column or self.default_col
-        
-        tab = tab.set_column(tab.column_names.index(column),column,pc.utf8_upper(tab[column]))
-        return tab
+        col = tab[column]
+
+        if pa.types.is_dictionary(col.type):
+            # Only uppercase the dictionaries, then remap indices onto the unique uppercased values
+            chunks = []
+            for chunk in col.chunks:
+                upper = pc.dictionary_encode(pc.utf8_upper(chunk.dictionary))
+                chunks.append(pa.DictionaryArray.from_arrays(pc.take(upper.indices, chunk.indices), upper.dictionary))
+            col = pa.chunked_array(chunks, type=col.type)
+        else:
+            col = pc.utf8_upper(col)
+        return tab.set_column(tab.column_names.index(column),column,col)
 
-    def _cast_column(self, tab, column, dtype):
-        """Casts column defined in tab as dtype
+    def parse_censored(self, tab):
+        """Splits censored values (e.g. '>89') in CENSORED_COLS into their bound and a <column>_censored flag
 
         Parameters
         ----------
-        tab : pyarrrow.Table
-                 Table to use
-        column : str
-                 column of tab to cast
-        dtype : str
-                 dtype to cast column as
+        tab : pyarrow.Table
+                 Table read from the raw csv
         """
-        assert column in tab.column_names, '{} not in {}'.format(column,tab.column_names)
-        
-        return tab.set_column(tab.column_names.index(column),column,pc.cast(tab[column],'string'))
+        declared = SCHEMAS.get(self.table_fn)
+        for column in CENSORED_COLS.get(self.table_fn, []):
+            flag_col = '{}_censored'.format(column)
+            if column not in tab.column_names or flag_col in tab.column_names:
+                continue
+            col = tab[column]
+            if pa.types.is_string(col.type):
+                flag = pc.fill_null(pc.starts_with(col, pattern='>'), False)
+                bound = pc.utf8_ltrim(col, characters='>')
+                value = pc.cast(pc.if_else(pc.utf8_is_digit(bound), bound, None), declared.field(column).type)
+            else:
+                # Already typed (e.g. an older parquet cache), nothing was censored
+                flag = pa.array(np.zeros(len(col), dtype=bool))
+                value = pc.cast(col, declared.field(column).type)
+            # The flag goes right after its column, matching schema
+            i = tab.column_names.index(column)
+            tab = tab.set_column(i, column, value).add_column(i+1, flag_col, flag)
+        return tab
+
+    def cast_declared(self, tab):
+        """Leniently casts the numeric and boolean columns read as strings to their declared SCHEMAS types"""
+        declared = SCHEMAS.get(self.table_fn, pa.schema([]))
+        censored = CENSORED_COLS.get(self.table_fn, [])
+        for f in declared:
+            if f.name in censored or f.name not in tab.column_names:
+                continue
+            col = tab[f.name]
+            if pa.types.is_string(col.type) and not pa.types.is_string(f.type) and not pa.types.is_dictionary(f.type):
+                tab = tab.set_column(tab.column_names.index(f.name), f.name, lenient_cast(col, f.type))
+        return tab
+
+    def _decode(self, tab):
+        """Sanitizes, casts and parses censored columns of a table read from the raw csv"""
+        if SANITIZE_COLS.get(self.table_fn) is not None and self.default_col in tab.column_names:
+            tab = self.sanitize_table(tab)
+        return self.parse_censored(self.cast_declared(tab))
 
     def partition(self, column=None, overwrite=False):
         """Breaks up dataset into separate files partitioned on column
@@ -129,108 +329,519 @@ class Table(object):
         if not overwrite and os.path.exists(out_dir):
             raise IOError('cache already exists, use overwrite parameter to overwrite directory')
         
-        tab = csv.read_csv(self.file_path)
+        tab = self._read_csv()
         tab = tab.set_column(tab.column_names.index(column),column,pc.cast(tab[column],'string'))
-        tab = self.sanitize_table(tab,column)
+        tab = self.parse_censored(self.cast_declared(self.sanitize_table(tab,column)))
 
         print('writing partitioned dataset {} sharding on {}'.format(out_dir, column))
         pq.write_to_dataset(tab,root_path=out_dir,partition_cols=[column],)
 
+    def _values_index_path(self, column):
+        return self._cache_path('.{}.values'.format(slugify(column)))
+
+    def build_values_index(self, column=None):
+        """Counts the distinct values of column in one streaming pass and persists them beside the table
+
+        The index holds each value, in the column's declared type (strings uppercased),
+        with its count and, when reading from the single file parquet cache, the row
+        groups it appears in. It's keyed on the source file's mtime so it's rebuilt
+        automatically when the data changes.
+
+        Parameters
+        ----------
+        column : str
+                 Column to index, defaults to the table's search column
+        """
+        column = column or self.default_col
+        counts = {}
+        row_groups = None
+
+        def add(arr, rg=None):
+            arr = self.cast_declared(pa.table({column: arr}))[column]
+            if pa.types.is_dictionary(arr.type):
+                arr = arr.cast(arr.type.value_type)
+            if pa.types.is_string(arr.type):
+                arr = pc.utf8_upper(arr)
+            vc = pc.value_counts(arr)
+            for v,n in zip(vc.field('values').to_pylist(), vc.field('counts').to_pylist()):
+                if v is None:
+                    continue
+                counts[v] = counts.get(v,0) + n
+                if rg is not None:
+                    row_groups.setdefault(str(v).upper(),[]).append(rg)
+
+        source = self._source_path()
+        if source is not None and source.endswith('.parquet'):
+            pf = pq.ParquetFile(source)
+            row_groups = {}
+            for i in range(pf.metadata.num_row_groups):
+                add(pf.read_row_group(i, columns=[column])[column], rg=i)
+        else:
+            for batch in self._dataset().to_batches(columns=[column]):
+                add(batch.column(0))
+
+        index = {
+            'column' : column,
+            'source_mtime' : os.path.getmtime(self.file_path),
+            'row_group_mtime' : os.path.getmtime(source) if row_groups is not None else None,
+            'values' : list(counts.keys()),
+            'counts' : list(counts.values()),
+            'row_groups' : row_groups,
+        }
+        try:
+            with open(self._values_index_path(column),'w') as f:
+                json.dump(index, f)
+        except (IOError, OSError):
+            print('unable to write values index for {}, keeping it in memory'.format(column))
+        self._values_index[column] = index
+        return index
+
+    def _load_values_index(self, column, build=True):
+        """Returns the current values index of column, building it if it's missing or stale"""
+        index = self._values_index.get(column)
+        fp = self._values_index_path(column)
+        if index is None and os.path.exists(fp):
+            with open(fp) as f:
+                index = json.load(f)
+
+        # Indexes written before values kept their types (no 'counts') are rebuilt
+        if index is not None and (index['source_mtime'] != os.path.getmtime(self.file_path) or 'counts' not in index):
+            index = None
+        if index is None:
+            return self.build_values_index(column) if build else None
+
+        # Row group lists are only valid for the parquet file they were read from
+        if index['row_groups'] is not None:
+            rg_fp = self._cache_path('.parquet')
+            if not os.path.exists(rg_fp) or index['row_group_mtime'] != os.path.getmtime(rg_fp):
+                index = dict(index, row_groups=None)
+        self._values_index[column] = index
+        return index
+
     def unique(self, column=None, count=True):
-        """Returns unique values from the default column (e.g. order_name from procedures)
+        """Returns unique values from column, defaults to the search column (e.g. order_name from procedures)
+
+        Answered from the persisted values index (see build_values_index), which only
+        reads the one column
         """
-        column = None or self.default_col
-        if self.default_unique is None:
-            self.default_unique = csv.read_csv(self.file_path)[column].to_pandas().astype(str).str.upper().unique()
+        column = column or self.default_col
+        index = self._load_values_index(column)
+        values = pd.Series(index['values'], name=column)
             
         if count:
-            return csv.read_csv(self.file_path)[column].to_pandas().astype(str).str.upper().value_counts()
+            return pd.Series(index['counts'], index=pd.Index(values), name=column, dtype=int).sort_values(ascending=False)
         else:
-            return self.default_unique
+            return values.to_numpy()
         
-    def search(self, query, column = None):
+    def search(self, query, column = None, regex=False, ignore_case=False):
         """Returns all unique entries of the specified column that match query
         Parameters
         ----------
-        query : str
-                 string to search column with
+        query : str or list
+                 string (or list of strings matched in one pass) to search column with
         column : str
                  Column to search for using query string, if none provided will search tables default column
+        regex : bool
+                 Treat query as a regular expression
+        ignore_case : bool
+                 Match case insensitively
         """
         if column is None and self.default_col is None:
             raise ValueError('No default search column specified, must provide column to search in column argument')
-        elif column is None and self.default_col is not None:
-            series = pd.Series(self.unique(count=False))
-        elif column is not None:
-            series = csv.read_csv(self.file_path)[column].to_pandas()
+        else:
+            series = pd.Series(self.unique(column, count=False))
         
-        return search(query, series)
+        return search(query, series, regex=regex, ignore_case=ignore_case)
     
+    def _value_set(self, typ, values):
+        """Casts query values to an arrow array matching a column of type typ"""
+        if pa.types.is_dictionary(typ):
+            typ = typ.value_type
+        return pc.cast(pa.array(np.asarray(values)), typ)
+
     def _filter_table(self, tab, **kwargs):
+        """Keeps the rows of tab matching every column=[val1, val2, ...] in kwargs
+
+        All the is_in tests and the day offset checks (rows with missing or censored
+        day offsets are dropped) are combined into one mask so tab is only copied once.
+        """
+        masks = [pc.is_in(tab[k], value_set=self._value_set(tab.schema.field(k).type, v)) for k,v in kwargs.items()]
+
+        for n in CENSORED_COLS.get(self.table_fn, []):
+            flag_col = '{}_censored'.format(n)
+            if ('days_from' in n or 'days_since' in n) and n in tab.column_names and flag_col in tab.column_names:
+                masks.append(pc.is_valid(tab[n]))
+                masks.append(pc.invert(tab[flag_col]))
+
+        if len(masks) == 0:
+            return tab
+        mask = masks[0]
+        for m in masks[1:]:
+            mask = pc.and_(mask, m)
+        return tab.filter(mask)
+
+    def _dataset(self, cache=True):
+        """Returns a pyarrow.dataset over the fastest available source of this table
+
+        Parameters
+        ----------
+        cache : bool
+                 Use a parquet cache if one exists, otherwise scan the raw csv
+        """
+        if cache and os.path.exists(self._cache_path('.part')):
+            return ds.dataset(self._cache_path('.part'), format='parquet', partitioning=ds.HivePartitioning.discover(infer_dictionary=True))
+        elif cache and os.path.exists(self._cache_path('.parquet')):
+            return ds.dataset(self._cache_path('.parquet'), format='parquet')
+        else:
+            return ds.dataset(self.file_path, format='csv', schema=self.raw_schema)
+
+    def _pushdown_expression(self, dataset, sanitized=False, **kwargs):
+        """Builds a dataset filter expression from sel style kwargs
+
+        The search column is uppercased by sanitize_table, when the source wasn't written
+        sanitized (i.e. the raw csv) it's matched as utf8_upper(column). The other
+        SANITIZE_COLS of a raw source are left for _filter_table to apply after the scan.
+
+        Parameters
+        ----------
+        dataset : pyarrow.dataset.Dataset
+                 Dataset the expression will be applied to
+        sanitized : bool
+                 Whether the search columns in dataset are already uppercased
+        """
+        raw_cols = SANITIZE_COLS.get(self.table_fn) or []
+        expr = None
         for k,v in kwargs.items():
-            tab = tab.filter(
-                pc.is_in(tab[k],value_set=pa.array(v))
-            )
-
-        for n in tab.column_names:
-            if 'days_from' in n or 'days_since' in n:
-                tab = self._cast_column(tab,n,'string')
-                mask = pc.invert(pc.starts_with(tab.column(n),pattern='>'))
-                tab = tab.filter(mask)
-
-                mask = pc.utf8_is_numeric(tab.column(n))
-                tab = tab.filter(mask)
-        return tab
+            upper = not sanitized and k == self.default_col and k in raw_cols
+            if k not in dataset.schema.names or (not sanitized and k in raw_cols and not upper):
+                continue
+            try:
+                value_set = self._value_set(dataset.schema.field(k).type, v)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                # Leave filters we can't type match to _filter_table
+                continue
+            f = ds.field(k)
+            if upper:
+                f = pc.utf8_upper(f.cast(pa.string()))
+            f = f.isin(value_set)
+            expr = f if expr is None else expr & f
+        return expr
+
+    def _read_columns(self, dataset, from_csv, columns=None, **kwargs):
+        """Columns to read for a projected query, adds the ones needed to filter and sanitize
+
+        Filtered queries also read the censored day offsets (and their flags from a cache)
+        so _filter_table drops the same rows as an unprojected query
+        """
+        if columns is None:
+            return None
+        # Censored flags are derived from their column when reading the raw csv
+        flags = {'{}_censored'.format(c):c for c in CENSORED_COLS.get(self.table_fn, [])} if from_csv else {}
+        read_cols = list(pd.unique(pd.Series([flags.get(c,c) for c in columns], dtype=object)))
+        read_cols += [k for k in kwargs.keys() if k in dataset.schema.names and k not in read_cols]
+        if any(k in dataset.schema.names for k in kwargs.keys()):
+            days = [c for c in CENSORED_COLS.get(self.table_fn, []) if 'days_from' in c or 'days_since' in c]
+            days += [] if from_csv else ['{}_censored'.format(c) for c in days]
+            read_cols += [c for c in days if c in dataset.schema.names and c not in read_cols]
+        if from_csv and SANITIZE_COLS.get(self.table_fn) is not None and self.default_col not in read_cols:
+            read_cols.append(self.default_col)
+        return read_cols
+
+    def _finish(self, tab, from_csv, columns=None, **kwargs):
+        """Decodes, filters and projects a freshly read pyarrow.Table"""
+        if from_csv:
+            tab = self._decode(tab)
 
-    def load_csv(self,**kwargs):
-        tab = csv.read_csv(self.file_path)
-        if SANITIZE_COLS[self.table_fn] is not None:
-            tab = self.sanitize_table(tab)
-        
         # Check if kwargs specifies returning a filtered table
-        return_filtered = pd.Series([k in tab.column_names for k in kwargs.keys()]).any()
+        return_filtered = any(k in tab.column_names for k in kwargs.keys())
         if return_filtered:
-            return self._filter_table(tab,**kwargs).to_pandas()
-        else:
-            return tab.to_pandas()
+            tab = self._filter_table(tab, **kwargs)
+
+        if columns is not None:
+            tab = tab.select(list(columns))
+        return tab
+
+    def scan(self, cache=True, columns=None, **kwargs):
+        """Scans the table returning only the rows matching kwargs as a pyarrow.Table
+
+        Filters are pushed down into the dataset scanner so only matching record
+        batches (or parquet row groups) are materialized instead of the entire file.
+
+        Parameters
+        ----------
+        cache : bool
+                 Use a parquet cache if one exists
+        columns : list
+                 Only read these columns, defaults to all columns
+        kwargs : dict
+                 column=[val1, val2, ...] filters
+        """
+        from_csv = not (cache and self._cache_exists())
+        source = self._source_path(cache=cache)
+        tab = self.table_cache.get(source) if source is not None else None
+
+        if tab is None and source is not None and self.table_cache.admits(self._source_nbytes(source), source):
+            # Small enough to keep in memory, decode the whole table once and reuse it
+            tab = self._decode_whole(source, cache, from_csv)
+        if tab is None:
+            dataset = self._dataset(cache=cache)
+            expr = self._pushdown_expression(dataset, sanitized=not from_csv, **kwargs)
+            read_cols = self._read_columns(dataset, from_csv, columns, **kwargs)
+
+            row_groups = self._indexed_row_groups(**kwargs) if source is not None and not from_csv else None
+            if row_groups is not None:
+                # Encounter layout, jump straight to the row groups holding the requested encounters
+                tab = self._finish(pq.ParquetFile(source).read_row_groups(row_groups, columns=read_cols), False, **kwargs)
+            else:
+                # Decode and filter batch by batch so only the matching rows are held in memory
+                schema = pa.schema([dataset.schema.field(c) for c in read_cols]) if read_cols is not None else dataset.schema
+                tabs = [self._finish(pa.Table.from_batches([b], schema=schema), from_csv, **kwargs) for b in dataset.to_batches(columns=read_cols, filter=expr)]
+                tab = pa.concat_tables(tabs) if len(tabs) > 0 else self._finish(schema.empty_table(), from_csv, **kwargs)
+            if columns is None and source is None:
+                # Partitioned caches read their partition column last, put it back in schema order
+                columns = self.schema.names
+            return tab.select(list(columns)) if columns is not None else tab
 
-    def partition_load(self,**kwargs):
+        return self._finish(tab, False, columns, **kwargs)
+
+    def _decode_whole(self, source, cache, from_csv):
+        """Decodes the whole table into the table cache
+
+        Gives up, returning None, as soon as the batches read exceed the cache's budget.
+        Either way a table that doesn't fit is rejected so later scans go straight to the
+        pushdown path instead of decoding the whole file again.
+        """
+        dataset = self._dataset(cache=cache)
+        batches, nbytes = [], 0
+        for batch in dataset.to_batches():
+            nbytes += batch.nbytes
+            if not self.table_cache.admits(nbytes):
+                self.table_cache.reject(source, nbytes)
+                return None
+            batches.append(batch)
+        tab = self._finish(pa.Table.from_batches(batches, schema=dataset.schema), from_csv)
+        self.table_cache.put(source, tab)
+        return tab
+
+    def iter_sel(self, *args, cache=True, columns=None, batch_size=1000000, **kwargs):
+        """Streams the rows matching a sel style query as pyarrow.Tables of at most batch_size rows
+
+        Only one batch is decoded at a time so peak memory is bounded by batch_size
+        rather than by the size of the file.
+
+        Parameters
+        ----------
+        cache : bool
+                 Use a parquet cache if one exists
+        columns : list
+                 Only read these columns, defaults to all columns
+        batch_size : int
+                 Maximum number of rows read per batch
+        """
+        kwargs = self._query_kwargs(*args, **kwargs)
+        from_csv = not (cache and self._cache_exists())
+        dataset = self._dataset(cache=cache)
+        expr = self._pushdown_expression(dataset, sanitized=not from_csv, **kwargs)
+        read_cols = self._read_columns(dataset, from_csv, columns, **kwargs)
+        if columns is None and cache and os.path.exists(self._cache_path('.part')):
+            # Partitioned caches read their partition column last, put it back in schema order
+            columns = self.schema.names
+
+        for batch in dataset.to_batches(columns=read_cols, filter=expr, batch_size=batch_size):
+            tab = self._finish(pa.Table.from_batches([batch]), from_csv, columns, **kwargs)
+            if tab.num_rows > 0:
+                yield tab
+
+    def _to_pandas(self, tab, categorical=True):
+        """Converts a scanned table to a DataFrame dropping rows without an encounter_id
+
+        Dictionary encoded name columns become pandas Categoricals holding only the
+        categories present, or plain strings when categorical is False.
+        """
+        if 'encounter_id' in tab.column_names and tab['encounter_id'].null_count > 0:
+            tab = tab.filter(pc.is_valid(tab['encounter_id']))
+        dict_cols = [f.name for f in tab.schema if pa.types.is_dictionary(f.type)]
+        if not categorical:
+            for c in dict_cols:
+                tab = tab.set_column(tab.column_names.index(c), c, pc.cast(tab[c], tab.schema.field(c).type.value_type))
+        df = tab.to_pandas()
+        if categorical:
+            for c in dict_cols:
+                df[c] = df[c].cat.remove_unused_categories()
+        return df
+
+    def load_csv(self, columns=None, categorical=True, **kwargs):
+        return self._to_pandas(self.scan(cache=False, columns=columns, **kwargs), categorical)
+
+    def partition_load(self, columns=None, categorical=True, **kwargs):
         if os.path.exists(self._cache_path('.part')):
-            tab = pq.read_table(self._cache_path('.part'))
-            # for c in STRING_COLS[self.table_fn]:
-            #     tab = self.sanitize_table(tab,c)
-            return self._filter_table(tab, **kwargs).to_pandas()
-            # self.df = load_table(self.data_root,self.table_fn.replace('csv','part'), load_func=pq.read_table()).to_pandas()
-            # self.df = load_table(self.data_root,self.table_fn.replace('csv','parquet'), load_func=pd.read_parquet(),engine='pyarrow')
-
-    def sel(self, *args, cache=True, pivot=False, rename_columns=False, **kwargs):
+            return self._to_pandas(self.scan(cache=True, columns=columns, **kwargs), categorical)
+
+    def parquet_load(self, columns=None, categorical=True, **kwargs):
+        """Loads rows matching kwargs from the single file parquet cache
+
+        Row groups whose encounter_id / search column statistics can't match the
+        query are skipped without being read.
+
+        Parameters
+        ----------
+        columns : list
+                 Only read these columns, defaults to all columns
+        categorical : bool
+                 Return name columns as pandas Categoricals
+        """
+        if os.path.exists(self._cache_path('.parquet')):
+            return self._to_pandas(self.scan(cache=True, columns=columns, **kwargs), categorical)
+
+    def build_parquet_cache(self, row_group_size=250000, layout='search', overwrite=False):
+        """Writes the table to a single sorted parquet file used as the default fast path by sel
+
+        String columns are dictionary encoded and rows are sorted according to layout
+        so row group statistics stay tight.
+
+        Parameters
+        ----------
+        row_group_size : int
+                 Maximum number of rows per row group
+        layout : str
+                 'search' sorts on (search column, encounter_id). 'encounter' sorts on
+                 (encounter_id, search column, time) and writes a sidecar row group index
+                 so sel(encounter_id=...) only reads the row groups holding those encounters
+        overwrite : bool
+                 The default value of false will raise errors if there is an existing cache file
+        """
+        layouts = {
+            'search' : [self.default_col,'encounter_id'],
+            'encounter' : ['encounter_id',self.default_col]+TIME_COLS.get(self.table_fn,[]),
+        }
+        assert layout in layouts.keys(), 'layout must be one of {}'.format(list(layouts.keys()))
+        out_fp = self._cache_path('.parquet')
+        if not overwrite and os.path.exists(out_fp):
+            raise IOError('cache already exists, use overwrite parameter to overwrite file')
+
+        tab = self._decode(self._read_csv())
+
+        sort_keys = [(c,'ascending') for c in pd.unique(pd.Series(layouts[layout]).dropna()) if c in tab.column_names]
+        if len(sort_keys) > 0:
+            # Dictionary columns can't be sorted directly, sort on their decoded values
+            keys = pa.table({c: pc.cast(tab[c], tab.schema.field(c).type.value_type) if pa.types.is_dictionary(tab.schema.field(c).type) else tab[c] for c,_ in sort_keys})
+            tab = tab.take(pc.sort_indices(keys, sort_keys=sort_keys))
+        string_cols = [f.name for f in tab.schema if pa.types.is_string(f.type) or pa.types.is_dictionary(f.type)]
+
+        print('writing parquet cache {}'.format(out_fp))
+        pq.write_table(tab, out_fp, row_group_size=row_group_size, use_dictionary=string_cols)
+
+        if os.path.exists(self._index_path()):
+            os.remove(self._index_path())
+        if layout == 'encounter' and 'encounter_id' in tab.column_names:
+            self._write_row_group_index(out_fp)
+
+    def _index_path(self):
+        return self._cache_path('.parquet.idx')
+
+    def _write_row_group_index(self, fp):
+        """Writes and returns a sidecar of per row group encounter_id min/max for an encounter sorted parquet file"""
+        meta = pq.ParquetFile(fp).metadata
+        col = meta.schema.names.index('encounter_id')
+        bounds = []
+        for i in range(meta.num_row_groups):
+            stats = meta.row_group(i).column(col).statistics
+            if stats is None or not stats.has_min_max:
+                # Without statistics every row group could hold any encounter, don't index
+                if os.path.exists(self._index_path()):
+                    os.remove(self._index_path())
+                return None
+            bounds.append([int(stats.min), int(stats.max)])
+
+        index = {'source_mtime': os.path.getmtime(fp), 'encounter_id': bounds}
+        with open(self._index_path(),'w') as f:
+            json.dump(index, f)
+        return index
+
+    def _indexed_row_groups(self, **kwargs):
+        """Returns the row groups of the parquet cache that can hold the requested rows
+
+        Uses the encounter_id row group index and the search column values index,
+        returns None when neither is valid for the query. An encounter_id index left
+        stale by a rewritten parquet file is rebuilt from the new file's statistics.
+        """
+        row_groups = None
+
+        idx_fp = self._index_path()
+        if 'encounter_id' in kwargs.keys() and os.path.exists(idx_fp):
+            fp = self._cache_path('.parquet')
+            with open(idx_fp) as f:
+                index = json.load(f)
+            if index['source_mtime'] != os.path.getmtime(fp):
+                print('rebuilding stale row group index {}'.format(idx_fp))
+                index = self._write_row_group_index(fp)
+            if index is not None:
+                bounds = np.array(index['encounter_id'], dtype=np.int64).reshape(-1,2)
+                eids = np.unique(np.asarray(kwargs['encounter_id'], dtype=np.int64))
+
+                # A row group is needed if any requested id falls within its [min, max]
+                hit = np.searchsorted(eids, bounds[:,0], side='left') < np.searchsorted(eids, bounds[:,1], side='right')
+                row_groups = set(np.flatnonzero(hit).tolist())
+
+        if self.default_col in kwargs.keys():
+            index = self._load_values_index(self.default_col, build=False)
+            if index is not None and index['row_groups'] is not None:
+                hit = set()
+                for v in kwargs[self.default_col]:
+                    hit.update(index['row_groups'].get(str(v).upper(),[]))
+                row_groups = hit if row_groups is None else row_groups & hit
+
+        return sorted(row_groups) if row_groups is not None else None
+
+    def _query_kwargs(self, *args, **kwargs):
+        """Normalizes sel(values) / sel(column=values) arguments into column filters"""
         if len(args) == 1 and len(kwargs.keys()) < 1 and self.default_col is None:
             raise ValueError('No default search column specified, must query in form of sel(column=[val1, val2, val3...])')
         elif len(args) == 1 and self.default_col is not None:
             kwargs = {
                 self.default_col : args[0]
             }
-        kwargs = {k:v for k,v in kwargs.items() if v is not None}
+        return {k:v for k,v in kwargs.items() if v is not None}
+
+    def sel(self, *args, cache=True, columns=None, categorical=True, pivot=False, rename_columns=False, streaming=False, batch_size=1000000, **kwargs):
+        """Returns the rows of the table matching a query as a DataFrame
 
-        if cache and self._cache_exists():
+        Query with sel([val1, val2...]) against the search column or
+        sel(column=[val1, val2, ...]) for any columns.
+
+        Parameters
+        ----------
+        cache : bool
+                 Use a parquet cache if one exists
+        columns : list
+                 Only read and return these columns, defaults to all columns
+        categorical : bool
+                 Return name columns (e.g. display_name) as pandas Categoricals, otherwise as strings
+        pivot : bool
+                 Pivot flowsheet values wide on display_name
+        streaming : bool
+                 Read the table in batches of batch_size rows keeping only the matching rows
+        """
+        kwargs = self._query_kwargs(*args, **kwargs)
+
+        if streaming:
+            # Only the filtered survivors of each batch are kept in memory
+            tabs = list(self.iter_sel(cache=cache, columns=columns, batch_size=batch_size, **kwargs))
+            if len(tabs) > 0:
+                df = self._to_pandas(pa.concat_tables(tabs), categorical)
+            else:
+                df = self._to_pandas(self.schema.empty_table().select(list(columns or self.schema.names)), categorical)
+        elif cache and self._cache_exists():
             if os.path.exists(self._cache_path('.part')):
-                df = self.partition_load(*args, **kwargs)
+                df = self.partition_load(columns=columns, categorical=categorical, **kwargs)
             elif os.path.exists(self._cache_path('.parquet')):
-                print('Parquet cache detected')
-                # table = self.parquet_load(*args, **kwargs)
+                df = self.parquet_load(columns=columns, categorical=categorical, **kwargs)
         else:
-            df = self.load_csv(**kwargs)
-
-        try:
-            df = df[~df.encounter_id.isna()]
-            df = df.astype(RAW_DTYPES[self.table_fn])
-        except:
-            print('error converting dataframe to RAW_DTYPES')
-            pass
+            df = self.load_csv(columns=columns, categorical=categorical, **kwargs)
 
         if pivot:
             df.flowsheet_value = df.flowsheet_value.replace({'':np.nan}).astype(float)
-            df = df.pivot_table(index=['encounter_id','flowsheet_days_since_birth'],columns='display_name',values='flowsheet_value')
+            df = df.pivot_table(index=['encounter_id','flowsheet_days_since_birth'],columns='display_name',values='flowsheet_value',observed=True)
         return df
 
         # if how == 'all':
@@ -242,10 +853,28 @@ class Table(object):
         # else:
 
     def columns(self):
-        return csv.read_csv(self.file_path,read_options=csv.ReadOptions(skip_rows_after_names=1500)).column_names
+        """Columns of the raw csv, without the <column>_censored flags added when decoding"""
+        return self.raw_schema.names
     
     def head(self):
-        return pd.DataFrame(columns=self.columns())
+        return self.schema.empty_table().to_pandas()
+
+    def _source_path(self, cache=True):
+        """Returns the single file scan would read from, or None for partitioned caches"""
+        if cache and os.path.exists(self._cache_path('.part')):
+            return None
+        elif cache and os.path.exists(self._cache_path('.parquet')):
+            return self._cache_path('.parquet')
+        else:
+            return self.file_path
+
+    def _source_nbytes(self, source):
+        """Estimates the decoded size in bytes of source"""
+        if source.endswith('.parquet'):
+            meta = pq.ParquetFile(source).metadata
+            return sum(meta.row_group(i).total_byte_size for i in range(meta.num_row_groups))
+        else:
+            return os.path.getsize(source)
 
     def _cache_path(self,ext='.parquet'):
         return os.path.join(self.data_root,self.table_fn.split('.')[0]+ext)
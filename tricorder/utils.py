@@ -1,10 +1,13 @@
 import os
 import pandas as pd
 import numpy as np
+import re
 import pyarrow
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import pyarrow.csv as csv
 import tarfile
+import datetime
 
 def unpack(tar_fp,data_root):
     file = tarfile.open(tar_fp)
@@ -27,61 +30,294 @@ def load_table(data_dir,fn,load_func=csv.read_csv,**kwargs):
     
     return check_and_load_csv(fp,load_func,**kwargs)
 
-def search(q,series):
-    idxs = [q in c for c in series.values]
-    return series[idxs]
+def search(q, series, regex=False, ignore_case=False):
+    """Returns the entries of series that contain q
+
+    Matching runs in pyarrow over the dictionary of distinct values, so each distinct
+    string is only tested once no matter how often it repeats.
+
+    Parameters
+    ----------
+    q : str or list of str
+             Substring (or regex) to search for, a list matches any of its entries in one pass
+    series : pd.Series
+             Values to search
+    regex : bool
+             Treat q as regular expression(s) instead of literal substrings
+    ignore_case : bool
+             Match case insensitively
+    """
+    patterns = [q] if isinstance(q, str) else list(q)
+    arr = pyarrow.array(np.asarray(series.values, dtype=object), type=pyarrow.string(), from_pandas=True)
+    encoded = arr.dictionary_encode()
+
+    if len(patterns) == 1 and not regex and not ignore_case:
+        matched = pc.match_substring(encoded.dictionary, pattern=patterns[0])
+    else:
+        pattern = '|'.join(p if regex else re.escape(p) for p in patterns)
+        if ignore_case:
+            pattern = '(?i)' + pattern
+        matched = pc.match_substring_regex(encoded.dictionary, pattern=pattern)
+
+    mask = pc.fill_null(pc.take(matched, encoded.indices), False)
+    return series[mask.to_numpy(zero_copy_only=False)]
+
+NS_PER_DAY = 24 * 60 * 60 * 10**9
+NAT = np.iinfo(np.int64).min
+
+def _timedelta_ns(times):
+    """int64 nanoseconds of a timedelta array, NaT becomes NAT"""
+    return np.asarray(times).astype('timedelta64[ns]').view(np.int64)
+
+def _bins(ns, width, how='floor'):
+    """Bin number of each int64 ns time for bins of width ns, 'round' snaps to the nearest bin"""
+    if how == 'round':
+        ns = ns + width // 2
+    return ns // width
 
 def rebin_time(df, on=None, time_column='time'):
     accepted_binnings = ['hour','q4h','q8h','q12h','day']
     divisors = [1,4,8,12,24]
     assert on in accepted_binnings, 'binning must be one of {}'.format(accepted_binnings)
     on_map = {k:v for k,v in zip(accepted_binnings,divisors)}
-    
-    t = df.time / np.timedelta64(1,'D') * 24 / on_map[on]
 
-    df['btime'] = t.apply(np.floor) * on_map[on]
-    return df.copy()
+    ns = _timedelta_ns(df[time_column])
+    btime = (_bins(ns, on_map[on]*60*60*10**9) * on_map[on]).astype(float)
+    btime[ns == NAT] = np.nan
 
-def tidy_labs(df, hours=False):
-    
-    get_days = lambda d: pd.to_timedelta(d.lab_collection_days_since_birth-d.lab_collection_days_since_birth.min(),unit='day')
+    df = df.copy()
+    df['btime'] = btime
+    return df
 
-    df = df.rename(columns={'lab_component_name':'name','lab_result_value':'value','lab_collection_time':'time'})
-    df.value = pd.to_numeric(df.value,errors='coerce')
-    
-    days = df.lab_collection_days_since_birth.apply(lambda s: pd.to_timedelta(s,unit='day'))
-    
-    df.time = pd.to_timedelta(df.time) + days
-    df = df.dropna()
-    return df[['encounter_id','time','name','value']].sort_values(['encounter_id','time'],ascending=True)
+RESAMPLE_AGGS = ['mean','sum','min','max','first','last','count']
+
+def resample(df, freq, agg='mean', fill=None, limit=None, t='time', how='floor', origin=None):
+    """Buckets a tidy frame into fixed width time bins, returning a dense per encounter grid with one column per name
+
+    All encounters are binned at once with integer division of the int64 times, every bin
+    between an encounter's first and last observation gets a row.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+             Long frame with encounter_id, t (timedelta), name and value columns
+    freq : str or pd.Timedelta
+             Bin width, anything pd.Timedelta accepts (e.g. '1h', '4h', '15min', '1D')
+    agg : str, list or dict
+             Aggregation(s) of the values in each bin, any of RESAMPLE_AGGS (e.g. ['mean','max','last']).
+             {'value': [...]} is accepted as in DataFrame.agg. Multiple aggregations give (name, agg) columns
+    fill : str
+             'ffill' carries the last aggregated value forward into empty bins of the same encounter,
+             None leaves them NaN
+    limit : int
+             Maximum number of consecutive empty bins to fill
+    t : str
+             Time column, also the name of the bin level of the returned index
+    how : str
+             'floor' puts each time in the bin it falls in, 'round' in the nearest bin
+    origin : str
+             None labels bins by their time since t == 0, 'start' by the time since each encounter's first bin
+    """
+    if isinstance(agg, dict):
+        assert list(agg.keys()) == ['value'], 'only the value column can be aggregated'
+        agg = agg['value']
+    aggs = [agg] if isinstance(agg, str) else list(agg)
+    assert all(a in RESAMPLE_AGGS for a in aggs), 'agg must be in {}'.format(RESAMPLE_AGGS)
+    assert fill in [None, 'ffill'], "fill must be None or 'ffill'"
+    assert how in ['floor','round'], "how must be 'floor' or 'round'"
+    width = pd.Timedelta(freq).value
+
+    names = df['name'].array if isinstance(df['name'].dtype, pd.CategoricalDtype) else pd.Categorical(df['name'])
+    value = df['value'].to_numpy(dtype=float)
+    eid = df['encounter_id'].to_numpy()
+    ns = _timedelta_ns(df[t])
+    codes = names.codes
+
+    keep = ~(np.isnan(value) | pd.isna(eid)) & (ns != NAT) & (codes >= 0)
+    value, eid, ns, codes = value[keep], eid[keep], ns[keep], codes[keep]
+
+    used = np.bincount(codes, minlength=len(names.categories)) > 0
+    n = (np.cumsum(used) - 1)[codes]
+    name_levels = names.categories[used]
+    eid_levels, e = np.unique(eid, return_inverse=True)
+    b = _bins(ns, width, how)
+
+    # Sorted on (encounter, name, time) each (encounter, bin, name) cell is a contiguous run
+    order = np.lexsort((ns, n, e))
+    value, e, n, b = value[order], e[order], n[order], b[order]
+
+    e_starts = np.flatnonzero(np.r_[True, e[1:] != e[:-1]]) if len(e) else np.array([], dtype=int)
+    first_bin = np.minimum.reduceat(b, e_starts) if len(e) else np.array([], dtype=np.int64)
+    n_bins = (np.maximum.reduceat(b, e_starts) - first_bin + 1) if len(e) else np.array([], dtype=np.int64)
+    row_offset = np.cumsum(n_bins) - n_bins
+    n_rows = int(n_bins.sum())
+
+    cell = (row_offset[e] + b - first_bin[e]) * len(name_levels) + n
+    starts = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]]) if len(cell) else np.array([], dtype=int)
+    ends = np.r_[starts[1:], len(cell)]
+    counts = ends - starts
+
+    out = {}
+    for a in aggs:
+        if len(starts) == 0:
+            vals = np.array([])
+        elif a == 'mean':
+            vals = np.add.reduceat(value, starts) / counts
+        elif a == 'sum':
+            vals = np.add.reduceat(value, starts)
+        elif a == 'min':
+            vals = np.minimum.reduceat(value, starts)
+        elif a == 'max':
+            vals = np.maximum.reduceat(value, starts)
+        elif a == 'first':
+            vals = value[starts]
+        elif a == 'last':
+            vals = value[ends - 1]
+        elif a == 'count':
+            vals = counts.astype(float)
+        grid = np.full(n_rows * len(name_levels), 0.0 if a == 'count' else np.nan)
+        grid[cell[starts]] = vals
+        out[a] = grid.reshape(n_rows, len(name_levels))
+
+    row_e = np.repeat(np.arange(len(eid_levels)), n_bins)
+    row_bin = np.arange(n_rows) - row_offset[row_e]
+    if origin != 'start':
+        row_bin = row_bin + first_bin[row_e]
+
+    if fill == 'ffill' and n_rows > 0:
+        for a in aggs:
+            grid = out[a]
+            rows = np.arange(n_rows)[:,None]
+            last = np.maximum.accumulate(np.where(np.isnan(grid), -1, rows), axis=0)
+            ok = last >= row_offset[row_e][:,None]
+            if limit is not None:
+                ok &= rows - last <= limit
+            out[a] = np.where(ok, grid[last, np.arange(len(name_levels))], np.nan)
+
+    index = pd.MultiIndex.from_arrays(
+        [eid_levels[row_e], (row_bin * width).astype('timedelta64[ns]')], names=['encounter_id',t]
+    )
+    if len(aggs) == 1:
+        return pd.DataFrame(out[aggs[0]], index=index, columns=pd.Index(name_levels, name='name'))
+    columns = pd.MultiIndex.from_product([name_levels, aggs], names=['name','agg'])
+    wide = np.stack([out[a] for a in aggs], axis=2).reshape(n_rows, len(name_levels)*len(aggs))
+    return pd.DataFrame(wide, index=index, columns=columns)
+
+def _clock_ns(times):
+    """Parses times of day (HH:MM:SS strings, datetime.time or arrow time) into int64 nanoseconds"""
+    if isinstance(times, (pyarrow.Array, pyarrow.ChunkedArray)):
+        if pyarrow.types.is_time(times.type):
+            times = times.cast(pyarrow.time64('ns')).cast(pyarrow.int64()).fill_null(NAT)
+            return times.to_numpy()
+        times = times.to_numpy()
+
+    times = pd.Series(np.asarray(times))
+    first = times.dropna().head(1).tolist()
+    if len(first) > 0 and isinstance(first[0], datetime.time):
+        times = times.astype(str)
+
+    # Fixed width HH:MM:SS strings are decoded straight from their code points
+    codes = np.asarray(times.to_numpy(), dtype='U9').view(np.uint32).reshape(len(times), 9).astype(np.int64)
+    digits = codes[:,[0,1,3,4,6,7]] - ord('0')
+    fixed = (codes[:,2] == ord(':')) & (codes[:,5] == ord(':')) & (codes[:,8] == 0) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+    seconds = (digits[:,0]*10 + digits[:,1])*3600 + (digits[:,2]*10 + digits[:,3])*60 + digits[:,4]*10 + digits[:,5]
+    ns = np.where(fixed, seconds * 10**9, NAT)
+
+    # Anything else (H:MM:SS, fractional seconds, missing) goes through pandas
+    if not fixed.all():
+        rest = pd.to_timedelta(times[~fixed], errors='coerce').to_numpy().astype('timedelta64[ns]').view(np.int64)
+        ns[~fixed] = rest
+    return ns
+
+def elapsed_ns(days, times):
+    """Combines day offsets and HH:MM:SS times of day into int64 nanoseconds
+
+    Both columns are parsed in a single vectorized pass, rows where either can't
+    be parsed come back as NaT (the minimum int64).
 
-def tidy_flow(df,to_numeric=True):
-    df = df.rename(columns={'display_name':'name','flowsheet_value':'value','flowsheet_time':'time'})
-    get_days = lambda d: pd.to_timedelta(d.flowsheet_days_since_birth-d.flowsheet_days_since_birth.min(),unit='day')
+    Parameters
+    ----------
+    days : array-like
+             Day offsets (e.g. lab_collection_days_since_birth)
+    times : array-like
+             HH:MM:SS time of day strings
+    """
+    d = pd.to_numeric(pd.Series(np.asarray(days)), errors='coerce').to_numpy(dtype=float)
+    t = _clock_ns(times)
 
+    nat = np.isnan(d) | (t == NAT)
+    return np.where(nat, NAT, np.nan_to_num(d).astype(np.int64) * NS_PER_DAY + t)
 
+def _tidy(df, rename, days_col, time_col, to_numeric=True, numeric_ids=False, as_arrow=False):
+    """Vectorized core of the tidy_* functions
+
+    Builds the long (encounter_id, time, name, value) format from a raw table
+    without any row-wise apply. Accepts either a DataFrame or a pyarrow.Table;
+    as_arrow returns a pyarrow.Table and never builds intermediate DataFrames.
+    Categorical / dictionary encoded names stay encoded.
+    """
+    name_col = [c for c,v in rename.items() if v == 'name'][0]
+    if isinstance(df, pyarrow.Table):
+        cols = {rename.get(c,c): df[c] if c in (time_col, name_col) else df[c].to_numpy() for c in df.column_names}
+        na = np.zeros(df.num_rows, dtype=bool)
+        for c in df.column_names:
+            na |= df[c].is_null().to_numpy()
+        index = None
+    else:
+        cols = {rename.get(c,c): df[c].array if isinstance(df[c].dtype, pd.CategoricalDtype) else df[c].to_numpy() for c in df.columns}
+        na = df.isna().to_numpy().any(axis=1)
+        index = df.index
+
+    value = cols['value']
     if to_numeric:
-        df.value = pd.to_numeric(df.value,errors='coerce')
-    
-    days = df.flowsheet_days_since_birth.apply(lambda s: pd.to_timedelta(s,unit='day'))
-    
-    df.time = pd.to_timedelta(df.time) + days
-    df = df.dropna()
-    return df[['encounter_id','time','name','value']].sort_values(['encounter_id','time'],ascending=True)
+        value = pd.to_numeric(value, errors='coerce')
+        na |= np.isnan(value)
 
-def tidy_meds(df):
-    df = df.rename(columns={'medication_name':'name','dose':'value','administered_time':'time'})
+    eid = cols['encounter_id']
+    if numeric_ids:
+        eid = pd.to_numeric(eid, errors='coerce')
+        na |= np.isnan(eid)
 
-    df.value = pd.to_numeric(df.value,errors='coerce')
-    df.encounter_id = pd.to_numeric(df.encounter_id,errors='coerce')
-    
-    df.administered_days_since_birth = pd.to_numeric(df.administered_days_since_birth, errors='coerce')
-    
-    days = df.administered_days_since_birth.apply(lambda s: pd.to_timedelta(s,unit='day'))
-    
-    df.time = pd.to_timedelta(df.time) + days
-    df = df.dropna()
-    return df[['encounter_id','time','name','value']].sort_values(['encounter_id','time'],ascending=True)
+    time = elapsed_ns(cols[days_col], cols['time'])
+    na |= time == NAT
+
+    keep = np.flatnonzero(~na)
+    order = keep[np.lexsort((time[keep], eid[keep]))]
+
+    name = cols['name']
+    if isinstance(name, pyarrow.ChunkedArray):
+        name = name.take(order)
+        if not as_arrow:
+            name = name.to_pandas().array
+            if isinstance(name, pd.Categorical):
+                name = name.remove_unused_categories()
+    else:
+        name = name[order]
+
+    out = {
+        'encounter_id' : eid[order],
+        'time' : time[order],
+        'name' : name,
+        'value' : value[order],
+    }
+    if as_arrow:
+        out['time'] = pyarrow.array(out['time'], type=pyarrow.duration('ns'))
+        return pyarrow.table(out)
+    else:
+        out['time'] = out['time'].view('timedelta64[ns]')
+        return pd.DataFrame(out, index=index[order] if index is not None else None)
+
+def tidy_labs(df, hours=False, as_arrow=False):
+    rename = {'lab_component_name':'name','lab_result_value':'value','lab_collection_time':'time'}
+    return _tidy(df, rename, 'lab_collection_days_since_birth', 'lab_collection_time', as_arrow=as_arrow)
+
+def tidy_flow(df,to_numeric=True, as_arrow=False):
+    rename = {'display_name':'name','flowsheet_value':'value','flowsheet_time':'time'}
+    return _tidy(df, rename, 'flowsheet_days_since_birth', 'flowsheet_time', to_numeric=to_numeric, as_arrow=as_arrow)
+
+def tidy_meds(df, as_arrow=False):
+    rename = {'medication_name':'name','dose':'value','administered_time':'time'}
+    return _tidy(df, rename, 'administered_days_since_birth', 'administered_time', numeric_ids=True, as_arrow=as_arrow)
 
 def tidy_procs(df,t='time'):
     df = df.rename(columns={'order_name':'name', 'days_from_dob_procstart':'time'})
@@ -94,8 +330,86 @@ def tidy_procs(df,t='time'):
     df = df.dropna()
     return df[['encounter_id','time','name','value']].sort_values(['encounter_id','time'],ascending=True)
 
+def replace_names(names, mapping):
+    """Series.replace for name columns, only the categories are remapped when names is Categorical
+
+    Parameters
+    ----------
+    names : pd.Series
+             Names (e.g. the name column of a tidy frame)
+    mapping : dict
+             Old name to new name
+    """
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        return names.map(lambda n: mapping.get(n, n))
+    return names.replace(mapping)
+
 def pivot_tidy(df,t='time'):
-    return df.pivot_table(index=['encounter_id',t],values='value', aggfunc='mean', columns='name')
+    """Pivots a tidy frame wide, one column per name holding the mean value at each (encounter_id, t)
+
+    Same result as pivot_table(aggfunc='mean') without hashing every row. Rows come from
+    the boundaries of the (encounter_id, t) sorted keys (already sorted for tidy_* output),
+    names are integer coded and cells are averaged with np.bincount.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+             Long frame with encounter_id, t, name and value columns
+    t : str
+             Time column to pivot on (e.g. time or hour)
+    """
+    names = df['name'].array if isinstance(df['name'].dtype, pd.CategoricalDtype) else pd.Categorical(df['name'])
+    value = df['value'].to_numpy(dtype=float)
+    eid = df['encounter_id'].to_numpy()
+    time = df[t].to_numpy()
+    codes = names.codes
+
+    keep = ~(np.isnan(value) | pd.isna(eid) | pd.isna(time)) & (codes >= 0)
+    value, eid, time, codes = value[keep], eid[keep], time[keep], codes[keep]
+
+    # Only keep the names with values
+    used = np.bincount(codes, minlength=len(names.categories)) > 0
+    n = (np.cumsum(used) - 1)[codes]
+    columns = pd.Index(names.categories[used], name='name')
+
+    if len(value) > 1:
+        unsorted = (eid[1:] < eid[:-1]) | ((eid[1:] == eid[:-1]) & (time[1:] < time[:-1]))
+        if unsorted.any():
+            order = np.lexsort((time, eid))
+            value, eid, time, n = value[order], eid[order], time[order], n[order]
+
+    new_row = np.ones(len(value), dtype=bool)
+    new_row[1:] = (eid[1:] != eid[:-1]) | (time[1:] != time[:-1])
+    row_starts = np.flatnonzero(new_row)
+    index = pd.MultiIndex.from_arrays([eid[row_starts], time[row_starts]], names=['encounter_id',t])
+
+    cell = (np.cumsum(new_row) - 1) * len(columns) + n
+    size = len(row_starts) * len(columns)
+    with np.errstate(invalid='ignore'):
+        wide = np.bincount(cell, weights=value, minlength=size) / np.bincount(cell, minlength=size)
+    return pd.DataFrame(wide.reshape(len(row_starts), len(columns)), index=index, columns=columns)
 
 def melt_tidy(df,t='hour'):
-    return pd.melt(df.reset_index(),id_vars=['encounter_id',t],value_vars=df.reset_index().columns.tolist(),var_name='name')
\ No newline at end of file
+    """Melts a wide frame (e.g. from pivot_tidy) back to long (encounter_id, t, name, value) rows
+
+    Every column other than encounter_id and t is melted, names come back as a Categorical.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+             Wide frame with encounter_id and t in its index or columns
+    t : str
+             Time column (e.g. time or hour)
+    """
+    ids = ['encounter_id',t]
+    keys = [df.index.get_level_values(k).to_numpy() if k in df.index.names else df[k].to_numpy() for k in ids]
+    value_cols = [c for c in df.columns if c not in ids]
+    values = df[value_cols].to_numpy()
+    rows = len(df)
+
+    return pd.DataFrame({
+        'encounter_id' : np.tile(keys[0], len(value_cols)),
+        t : np.tile(keys[1], len(value_cols)),
+        'name' : pd.Categorical.from_codes(np.repeat(np.arange(len(value_cols)), rows), categories=pd.Index(value_cols)),
+        'value' : values.ravel(order='F'),
+    })
\ No newline at end of file